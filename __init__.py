@@ -1,167 +1,53 @@
 from __future__ import annotations
 import os
-import re
-from html import escape
+import time
 import traceback
+from collections import Counter
 from typing import Optional, Dict, Any
 
-import requests  # uses Anki's bundled venv
+_T_IMPORT_START = time.perf_counter()
 
-from aqt import mw, gui_hooks
-from aqt.qt import QAction, QInputDialog, QKeySequence, QShortcut, QWidget
-from aqt.utils import showInfo, showWarning, tooltip
+try:
+    from aqt import mw, gui_hooks
+    from aqt.qt import QAction, QInputDialog, QKeySequence, QShortcut, QWidget
+    from aqt.utils import askUser, showInfo, showText, showWarning, tooltip
+except ImportError:
+    # ヘッドレス実行（cli.py）では aqt がなくてもよい。core だけ使う
+    mw = None
+    gui_hooks = None
 
-AddonConfig = Dict[str, Any]
-
-
-# ==============================
-# Config helper
-# ==============================
-
-def _get_config() -> AddonConfig:
-    cfg = mw.addonManager.getConfig(__name__)
-    return cfg or {}
+# ★ requests / プロンプト生成 (core) / config_gui は初回使用時に import する（起動を軽くする）
 
+AddonConfig = Dict[str, Any]
 
-# Helpers to fetch numbered keys
-def cfg_get(cfg: dict, key: str, default=None):
-    return cfg.get(key, default)
+# 起動時間（ms）。デバッグコンソールとバッチのレポートに出す
+_STARTUP_MS: Dict[str, float] = {}
 
 
 # ==============================
-# Prompt building
+# Config helper
 # ==============================
 
-def _build_prompts(question: str, answer: str, cfg: AddonConfig) -> tuple[str, str]:
-    # --- Domain (new) with backward compat ---
-    # new key: 03_domain = "medical" | "general"
-    # old key: 03_audience (legacy) - used only if 03_domain is missing
-    domain = cfg_get(cfg, "03_domain", None)
-    if not domain:
-        domain = cfg_get(cfg, "03_audience", "general")
-    domain = str(domain).lower().strip()
-    if domain not in ("medical", "general"):
-        domain = "medical"
-
-    # --- Language ---
-    language = str(cfg_get(cfg, "03_language", "ja") or "ja").lower().strip()
-    LANG_MAP = {
-        "ja": "Japanese",
-        "en": "English",
-        "de": "German",
-        "fr": "French",
-        "es": "Spanish",
-        "zh": "Chinese",
-        "ko": "Korean",
-        "it": "Italian",
-        "pt": "Portuguese",
-        "ru": "Russian",
-        "ar": "Arabic",
-    }
-    lang_label = LANG_MAP.get(language, "English")
-
-    # --- Style / Length ---
-    style = cfg_get(cfg, "03_explanation_style", "definition_and_mechanism")
-    target_len = int(cfg_get(cfg, "03_target_length_chars", 260))
-    target_len = max(80, min(800, target_len))
-
-    # --- System prompt: domain switch (English only; output language is controlled below) ---
-    if domain == "medical":
-        system_prompt = (
-            "You are an expert medical tutor. "
-            "Write an explanation suitable for medical/health-science students. "
-            "Be accurate. Avoid unnecessary chatter."
-        )
-    else:
-        system_prompt = (
-            "You are an expert tutor across many subjects. "
-            "Write an explanation suitable for learners. "
-            "Be accurate, clear, and avoid unnecessary digressions."
-        )
+_CONFIG_CACHE: Optional[AddonConfig] = None
 
-    # --- Style instructions ---
-    lines: list[str] = []
-    lines.append("1. Summarize the definition or overall idea first.")
 
-    if style in ("definition_and_mechanism", "full"):
-        if domain == "medical":
-            lines.append("2. Describe the mechanism/pathophysiology.")
-        else:
-            lines.append("2. Explain the reasoning, cause-effect, or the key concept.")
-
-    if style == "full":
-        if domain == "medical":
-            lines.append("3. Add brief clinical notes (high-yield points).")
-        else:
-            lines.append("3. Add helpful context (examples, common pitfalls, or why it matters).")
-
-    lines.append(f"Target length: ~{target_len} characters.")
-
-    # --- User prompt: language + strict output constraints ---
-
-    q = (question or "").strip()
-    a = (answer or "").strip()
-
-    parts: list[str] = []
-    parts.append("Please write an explanation for this Anki card.")
-    parts.append("")
+def _get_config() -> AddonConfig:
+    # 1回だけ読んでキャッシュする。設定の保存時に _invalidate_config で捨てる
+    global _CONFIG_CACHE
+    if _CONFIG_CACHE is None:
+        _CONFIG_CACHE = mw.addonManager.getConfig(__name__) or {}
+    return _CONFIG_CACHE
 
-    if q and a:
-        parts.append(f"Question:\n{q}\n")
-        parts.append(f"Answer:\n{a}\n")
-    elif q:
-        parts.append("Only the question is available (the answer field is empty or missing).")
-        parts.append(f"Question:\n{q}\n")
-        parts.append("Explain the concept being asked, and what kind of answer would be expected.")
-        parts.append("")
-    elif a:
-        parts.append("Only the answer is available (the question field is empty or missing).")
-        parts.append(f"Answer:\n{a}\n")
-        parts.append("Explain what this answer means, and typical contexts where it appears.")
-        parts.append("")
 
-    parts.append("\n".join(lines))
-    parts.append(f"\nThe output language MUST be {lang_label}.")
-    parts.append("Return HTML ONLY .")
-    parts.append("Do NOT wrap the output in markdown or code blocks.")
-    parts.append("Do NOT include ``` or ```html.")
-    parts.append(f"Keep the output around {target_len} characters.")
+def _invalidate_config(*args) -> None:
+    global _CONFIG_CACHE
+    _CONFIG_CACHE = None
 
-    user_prompt = "\n".join(parts) + "\n"
 
-    return system_prompt, user_prompt
-
-
-# ==============================
-# API calls (OpenAI / Gemini)
-# ==============================
-
-def _call_openai(api_key: str, model: str, system_prompt: str, user_prompt: str) -> str:
-    url = "https://api.openai.com/v1/chat/completions"
-    headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
-    body = {
-        "model": model,
-        "messages": [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt},
-        ],
-        "temperature": 0.2,
-        "max_tokens": 512,
-    }
-    r = requests.post(url, headers=headers, json=body, timeout=40)
-    r.raise_for_status()
-    return r.json()["choices"][0]["message"]["content"].strip()
-
-
-def _call_gemini(api_key: str, model: str, system_prompt: str, user_prompt: str) -> str:
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent"
-    headers = {"Content-Type": "application/json", "x-goog-api-key": api_key}
-    body = {"contents": [{"parts": [{"text": system_prompt + "\n\n" + user_prompt}]}]}
-    r = requests.post(url, headers=headers, json=body, timeout=40)
-    r.raise_for_status()
-    data = r.json()
-    parts = data["candidates"][0]["content"]["parts"]
-    return parts[0]["text"].strip()
+def _startup_summary() -> str:
+    imp = _STARTUP_MS.get("import", 0.0)
+    wiring = _STARTUP_MS.get("profile_wiring", 0.0)
+    return f"Add-on startup: {imp + wiring:.1f} ms (import {imp:.1f} ms, profile wiring {wiring:.1f} ms)"
 
 
 # ==============================
@@ -170,6 +56,8 @@ def _call_gemini(api_key: str, model: str, system_prompt: str, user_prompt: str)
 
 def _generate_for_note(note) -> tuple[Optional[str], Optional[str]]:
     # 互換のため残しておくが、今後は main-thread 専用として使う想定
+    from .core import _generate_html, _prepare_note_job_from_note
+
     cfg = _get_config()
     job, err = _prepare_note_job_from_note(note, cfg)
     if err:
@@ -181,116 +69,14 @@ def _generate_for_note(note) -> tuple[Optional[str], Optional[str]]:
     return (html, None) if ok else (None, err3)
 
 
-def _prepare_note_job_from_note(note, cfg: AddonConfig) -> tuple[Optional[dict], Optional[str]]:
-    q_field = cfg_get(cfg, "02_question_field", "Front")
-    a_field = cfg_get(cfg, "02_answer_field", "Back")
-    e_field = cfg_get(cfg, "02_explanation_field", "Explanation")
-
-    # フィールドが存在しない場合も即スキップにせず、存在する方だけ使う
-    question = ""
-    answer = ""
-    try:
-        question = (note[q_field] or "").strip()
-    except KeyError:
-        question = ""
-    try:
-        answer = (note[a_field] or "").strip()
-    except KeyError:
-        answer = ""
-
-    # 両方空なら無理
-    if (not question) and (not answer):
-        return None, "Question and answer are both empty (or missing)."
-
-    try:
-        existing_raw = note[e_field] or ""
-    except KeyError:
-        return None, "Explanation field does not exist."
-    behavior = cfg_get(cfg, "04_on_existing_behavior", "skip")
-    if existing_raw.strip() and behavior == "skip":
-        return None, "Explanation already exists."
-    sep = cfg_get(cfg, "04_append_separator", "\n<hr>\n")
-    return {
-        "nid": int(note.id),
-        "e_field": e_field,
-        "question": question,
-        "answer": answer,
-        "behavior": behavior,
-        "sep": sep,
-    }, None
-
-_RE_WHOLE_FENCE = re.compile(
-    r"^\s*```(?:\s*(?P<lang>[a-zA-Z0-9_-]+))?\s*\n(?P<body>.*)\n```\s*$",
-    re.DOTALL,
-)
-
-def _strip_markdown_fences(s: str) -> str:
-    if not s:
-        return ""
-    t = s.strip()
-
-    # 「全文が1つの ```...``` で包まれている」場合だけ剥がす
-    m = _RE_WHOLE_FENCE.match(t)
-    if m:
-        body = (m.group("body") or "").strip()
-        lang = (m.group("lang") or "").lower()
-
-        # 任意：HTMLっぽくない言語のときは剥がさない（保守的）
-        # 例: json / python が来たらそのまま返す
-        if lang and lang not in ("html", "htm", "xml"):
-            return t
-
-        return body
-
-    # それ以外は何もしない（消しすぎ防止）
-    return t
-
-
-def _generate_html(question: str, answer: str, cfg: AddonConfig) -> tuple[Optional[str], Optional[str]]:
-    system_prompt, user_prompt = _build_prompts(question, answer, cfg)
-    provider = cfg_get(cfg, "01_provider", "openai")
-    if provider == "openai":
-        api_key = cfg_get(cfg, "01_openai_api_key") or os.getenv("OPENAI_API_KEY")
-        model = cfg_get(cfg, "01_openai_model", "gpt-4o-mini")
-    else:
-        api_key = cfg_get(cfg, "01_gemini_api_key") or os.getenv("GEMINI_API_KEY")
-        model = cfg_get(cfg, "01_gemini_model", "gemini-2.5-flash-lite")
-
-    if not api_key:
-        return None, "API key not set."
-
-    try:
-        if provider == "openai":
-            raw = _call_openai(api_key, model, system_prompt, user_prompt)
-        else:
-            raw = _call_gemini(api_key, model, system_prompt, user_prompt)
-
-        html_out = _strip_markdown_fences(raw)
-
-        # 任意：最低限の安全チェック（事故防止）
-        if html_out and not html_out.lstrip().startswith("<"):
-            # ここは好み。エラーにするなら return None, ...
-            # とりあえずそのまま通すならコメントアウトでOK
-            pass
-
-        return html_out, None
-
-    except Exception as e:
-        traceback.print_exc()
-        return None, f"API error: {e}"
-
-
 def _apply_html_to_note(nid: int, e_field: str, html: str, behavior: str, sep: str) -> tuple[bool, Optional[str]]:
     # ★ note/col 操作はメインスレッド側で行う前提
+    from .core import _apply_html_to_note_fields
+
     note2 = mw.col.get_note(nid)
-    existing_raw = note2[e_field] or ""
-    existing = existing_raw.strip()
-    if existing and behavior == "skip":
-        return False, "Explanation already exists."
-    if existing and behavior == "append":
-        note2[e_field] = existing_raw + (sep or "\n<hr>\n") + html
-    else:
-        note2[e_field] = html
+    ok, err = _apply_html_to_note_fields(note2, e_field, html, behavior, sep)
+    if not ok:
+        return False, err
     note2.flush()
     return True, None
 
@@ -305,6 +91,8 @@ def _generate_for_current_card() -> None:
         tooltip("No current card.")
         return
 
+    from .core import _generate_html, _prepare_note_job_from_note
+
     note = card.note()
     cfg = _get_config()
     job, err = _prepare_note_job_from_note(note, cfg)
@@ -354,6 +142,8 @@ def _generate_for_current_card() -> None:
 # ==============================
 
 def _on_tools_generate_with_search() -> None:
+    from .core import cfg_get
+
     cfg = _get_config()
     deck_name = mw.col.decks.current()["name"]
     default_search = f'deck:"{deck_name}"'
@@ -373,58 +163,189 @@ def _on_tools_generate_with_search() -> None:
         return
 
     max_notes = int(cfg_get(cfg, "05_max_notes_per_run", 50))
-    target = nids[:max_notes]
+    _start_batch(nids[:max_notes], cfg)
+
+
+def _start_batch(target, cfg: AddonConfig, on_finished=None, monitor: Optional[dict] = None) -> None:
+    """
+    target（nid のリスト）をバックグラウンドで生成し、完了後にメインスレッドで書き込む。
+
+    on_finished を渡すとダイアログは出さずに集計 dict を渡して呼ぶ（soak テスト用）。
+    この場合は進捗ダイアログも出さない（モーダルなので Tools メニューから止められなくなる）。
+    monitor を渡すと _run_jobs が待ち行列の長さを書き込む。
+    """
+    from .core import RunBudget, _apply_html_to_note_fields, _prepare_note_jobs, _run_jobs
 
     # ★ 先に main thread で必要情報だけ抜き出す（max_notes が小さい想定なので軽い）
     jobs = []
     pre_skipped = 0
+    field_cache: dict = {}  # ノートタイプごとのフィールド解決結果
     for nid in target:
         note = mw.col.get_note(nid)
-        job, err = _prepare_note_job_from_note(note, cfg)
-        if err:
+        # fan-out（03_fanout_fields）では1ノートから言語ごとのジョブができる
+        note_jobs, err = _prepare_note_jobs(note, cfg, field_cache)
+        if not note_jobs:
             pre_skipped += 1
         else:
-            jobs.append(job)
+            jobs.extend(note_jobs)
+    # 未知の言語コードなど、設定の問題はノートタイプごとに1回だけ出す
+    config_problems = sorted({e for fields in field_cache.values() for e in fields["fanout_errors"]})
+
+    budget = RunBudget(cfg)
+    # parallel fan-out では1ノートの各言語を同時に投げる
+    # （ノートタイプ別の "fanout" もあるので、実際にできたジョブ数から決める）
+    per_note = Counter(job["nid"] for job in jobs)
+    workers = max(per_note.values(), default=1)
 
     def worker():
-        results = []
-        for job in jobs:
-            html, err = _generate_html(job["question"], job["answer"], cfg)
-            results.append((job, html, err))
-        return {"results": results, "total": len(target), "pre_skipped": pre_skipped}
+        stats: dict = {}
+        # 予算を超えたら新しいジョブは投げない（完了分はこのあと反映する）
+        results, remaining = _run_jobs(jobs, cfg, workers=workers, budget=budget, stats=stats, monitor=monitor)
+        return {
+            "results": results,
+            "remaining": list(dict.fromkeys(job["nid"] for job in remaining)),
+            "total": len(target),
+            "pre_skipped": pre_skipped,
+            "stats": stats,
+        }
+
+    show_progress = on_finished is None
 
     def on_done(fut):
         try:
             st = fut.result()
         except Exception as e:
-            showWarning(f"AI Card Explainer batch failed:\n{e}")
+            if show_progress:
+                mw.progress.finish()
             traceback.print_exc()
+            if on_finished:
+                on_finished({"error": str(e)})
+            else:
+                showWarning(f"AI Card Explainer batch failed:\n{e}")
             return
-        finally:
+        if show_progress:
             mw.progress.finish()
-        okc = sk = er = 0
+        # 集計はノート単位（fan-out で1ノートに複数フィールド書いても1件）
+        # 1言語でも失敗したノートはエラー、書き込めたノートは生成、それ以外はスキップ
+        # 同じノートへの書き込み（言語ごとのフィールド）はまとめて、最後に1回で保存する
+        by_nid: dict = {}
+        failed: set = set()
         for job, html, err in st["results"]:
             if html:
-                ok, err2 = _apply_html_to_note(job["nid"], job["e_field"], html, job["behavior"], job["sep"])
-                if ok:
-                    okc += 1
-                else:
-                    sk += 1
+                by_nid.setdefault(job["nid"], []).append((job, html))
             else:
-                er += 1
-        sk += int(st.get("pre_skipped", 0))
-        showInfo(
+                failed.add(job["nid"])
+        changed = []
+        skipped: set = set()
+        for nid, items in by_nid.items():
+            note = mw.col.get_note(nid)
+            wrote = False
+            for job, html in items:
+                ok, err2 = _apply_html_to_note_fields(note, job["e_field"], html, job["behavior"], job["sep"])
+                if ok:
+                    wrote = True
+            if wrote:
+                changed.append(note)
+            elif nid not in failed:
+                skipped.add(nid)
+        if changed:
+            mw.col.update_notes(changed)
+        er = len(failed)
+        okc = sum(1 for note in changed if int(note.id) not in failed)
+        sk = len(skipped) + int(st.get("pre_skipped", 0))
+        if on_finished:
+            on_finished({
+                "total": st["total"],
+                "generated": okc,
+                "skipped": sk,
+                "errors": er,
+                "remaining": len(st["remaining"]),
+                "stats": st["stats"],
+            })
+            return
+        msg = (
             "AI explanation batch finished.\n"
             f"Notes: {st['total']}\n"
             f"Generated: {okc}\n"
             f"Skipped: {sk}\n"
-            f"Errors: {er}"
+            f"Errors: {er}\n"
+            f"Repaired locally: {st['stats'].get('repaired', 0)}\n"
+            f"Re-requested: {st['stats'].get('rerequested', 0)}\n"
+            f"Deduplicated: {st['stats'].get('deduped', 0)}\n"
+            f"{budget.summary()}\n"
+            f"{_startup_summary()}"
+        )
+        if config_problems:
+            msg += "\n\nConfig problems:\n" + "\n".join(f"- {p}" for p in config_problems)
+        remaining = st["remaining"]
+        if not remaining:
+            showInfo(msg)
+            return
+        # 予算で止まった場合：残りのノートを検索クエリとして出す（Browse に貼って再実行できる）
+        showText(
+            msg + "\n\n"
+            f"Stopped early: {budget.stop_reason}\n"
+            f"Remaining (not processed): {len(remaining)}\n"
+            "nid:" + ",".join(str(nid) for nid in remaining),
+            parent=mw,
+            title="AI Card Explainer",
+            copyBtn=True,
         )
 
-    mw.progress.start(label="Batch generating explanations...", immediate=True)
+    if show_progress:
+        mw.progress.start(label="Batch generating explanations...", immediate=True)
     mw.taskman.run_in_background(worker, on_done)
 
 
+# ==============================
+# Soak test (08_soak_test_menu)
+# ==============================
+
+def _on_tools_soak_test() -> None:
+    from .soak import SoakTest
+
+    running = getattr(mw, "_ai_card_explainer_soak", None)
+    if running:
+        if askUser("A soak test is running. Stop it after the current iteration and write the report?"):
+            running.stop()
+        return
+
+    cfg = _get_config()
+    deck_name = mw.col.decks.current()["name"]
+    search, ok = QInputDialog.getText(
+        mw,
+        "AI Card Explainer — soak test",
+        "Notes to process in every iteration (search query):",
+        text=f'deck:"{deck_name}"',
+    )
+    if not ok or not search.strip():
+        return
+    nids = mw.col.find_notes(search)
+    if not nids:
+        showInfo("No matching notes.")
+        return
+    hours, ok = QInputDialog.getDouble(mw, "AI Card Explainer — soak test", "Duration (hours):", 2.0, 0.05, 48.0, 2)
+    if not ok:
+        return
+    if not askUser(
+        f"The soak test runs the batch over {len(nids)} notes again and again for {hours:g} h "
+        "against a local fake provider (no real API calls).\n\n"
+        "The explanation fields of these notes are OVERWRITTEN with fake text. "
+        "Use a test profile or a copy of the deck.\n\nStart?"
+    ):
+        return
+
+    def on_report(path: str, report: str) -> None:
+        mw._ai_card_explainer_soak = None
+        showText(f"Report written to:\n{path}\n\n{report}", parent=mw, title="AI Card Explainer — soak test", copyBtn=True)
+
+    out_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "user_files")
+    soak = SoakTest(list(nids), cfg, hours, out_dir, _start_batch, on_report)
+    mw._ai_card_explainer_soak = soak
+    soak.start()
+    tooltip("Soak test started. Use the same menu item to stop it.")
+
+
 # ==============================
 # Reviewer “More…” menu
 # ==============================
@@ -443,10 +364,16 @@ def _init_menu():
     act.triggered.connect(_on_tools_generate_with_search)
     mw.form.menuTools.addAction(act)
 
+    # 開発・検証用。普段はメニューに出さない
+    if _get_config().get("08_soak_test_menu", False):
+        act2 = QAction("AI Card Explainer: soak test (fake provider)", mw)
+        act2.triggered.connect(_on_tools_soak_test)
+        mw.form.menuTools.addAction(act2)
+
 
 def _init_shortcut():
     cfg = _get_config()
-    key = (cfg_get(cfg, "05_review_shortcut", "Ctrl+Shift+L") or "Ctrl+Shift+L").strip()
+    key = (cfg.get("05_review_shortcut", "Ctrl+Shift+L") or "Ctrl+Shift+L").strip()
     if not key:
         key = "Ctrl+Shift+L"
     sc = getattr(mw, "_ai_card_explainer_sc", None)
@@ -461,6 +388,11 @@ def _init_shortcut():
     sc2.activated.connect(_generate_for_current_card)
     mw._ai_card_explainer_sc = sc2
 
+
+def _on_config_applied() -> None:
+    _invalidate_config()
+    _init_shortcut()
+
 def _open_config_gui(*args, **kwargs) -> None:
     """
     Anki: Tools -> Add-ons -> Config を押したときに呼ばれる。
@@ -472,7 +404,7 @@ def _open_config_gui(*args, **kwargs) -> None:
         if args and isinstance(args[0], QWidget):
             parent = args[0]
         parent = kwargs.get("parent", parent) or mw
-        open_config_gui(__name__, parent=parent, on_apply=_init_shortcut)
+        open_config_gui(__name__, parent=parent, on_apply=_on_config_applied)
     except Exception as e:
         showWarning(f"Failed to open settings dialog:\n{e}")
         traceback.print_exc()
@@ -481,15 +413,24 @@ def _on_profile_loaded():
     if getattr(mw, "_ai_card_explainer_inited", False):
         return
     mw._ai_card_explainer_inited = True
+    t0 = time.perf_counter()
 
     _init_menu()
     gui_hooks.reviewer_will_show_context_menu.append(_on_reviewer_context_menu)
     _init_shortcut()
     try:
         mw.addonManager.setConfigAction(__name__, _open_config_gui)
+        # 設定を JSON エディタ等で保存された場合もキャッシュを捨てる
+        mw.addonManager.setConfigUpdatedAction(__name__, _invalidate_config)
     except Exception:
         # 古いAnki等で未対応でも落とさない
         pass
 
+    _STARTUP_MS["profile_wiring"] = (time.perf_counter() - t0) * 1000
+    print(f"AI Card Explainer: {_startup_summary()}")
+
+
+if gui_hooks is not None:
+    gui_hooks.profile_did_open.append(_on_profile_loaded)
 
-gui_hooks.profile_did_open.append(_on_profile_loaded)
+_STARTUP_MS["import"] = (time.perf_counter() - _T_IMPORT_START) * 1000
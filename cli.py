@@ -0,0 +1,219 @@
+# cli.py
+"""
+Headless batch generation (no Anki GUI).
+
+Run from the add-ons folder (the folder name is the add-on's directory):
+
+    python -m anki-ai-explainer.cli path/to/collection.anki2 --search 'deck:"Biology"'
+    python -m anki-ai-explainer.cli shared.apkg --output shared.explained.apkg
+
+Needs the `anki` Python package (pip install anki) and `requests`.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+from typing import Optional
+
+from .core import (
+    AddonConfig,
+    RunBudget,
+    _apply_html_to_note_fields,
+    _prepare_note_jobs,
+    _run_jobs,
+)
+
+ADDON_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _load_config(path: Optional[str]) -> AddonConfig:
+    # 同梱の config.json を土台にして、--config の JSON で上書きする
+    with open(os.path.join(ADDON_DIR, "config.json"), encoding="utf-8") as f:
+        cfg: AddonConfig = json.load(f)
+    if path:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        # Anki の meta.json をそのまま渡された場合は "config" の中身を使う
+        if isinstance(data.get("config"), dict):
+            data = data["config"]
+        cfg.update(data)
+    return cfg
+
+
+def _open_collection(path: str, workdir: str):
+    from anki.collection import Collection, ImportAnkiPackageOptions, ImportAnkiPackageRequest
+
+    if not path.lower().endswith(".apkg"):
+        return Collection(path)
+
+    # .apkg は一時コレクションに取り込んでから処理する
+    col = Collection(os.path.join(workdir, "collection.anki2"))
+    col.import_anki_package(
+        ImportAnkiPackageRequest(
+            package_path=os.path.abspath(path),
+            options=ImportAnkiPackageOptions(with_scheduling=True, with_deck_configs=True),
+        )
+    )
+    return col
+
+
+def _export_package(col, out_path: str) -> None:
+    from anki.collection import ExportAnkiPackageOptions
+
+    col.export_anki_package(
+        out_path=os.path.abspath(out_path),
+        options=ExportAnkiPackageOptions(with_scheduling=True, with_deck_configs=True, with_media=True),
+        limit=None,
+    )
+
+
+def run_batch(
+    col,
+    cfg: AddonConfig,
+    search: str,
+    limit: int = 0,
+    workers: int = 4,
+    chunk_size: int = 100,
+    budget: Optional[RunBudget] = None,
+) -> dict:
+    """
+    Generate explanations for notes matching `search` and write them back.
+
+    Network calls run on `workers` threads; collection access stays on the
+    calling thread and notes are saved with one `update_notes` per chunk.
+    When `budget` is exceeded no new requests are started; finished results
+    are still written and the unprocessed nids are returned in "remaining".
+    """
+    nids = list(col.find_notes(search))
+    if limit > 0:
+        nids = nids[:limit]
+
+    report = {
+        "total": len(nids), "generated": 0, "skipped": 0, "errors": 0, "stats": {}, "remaining": [],
+        "config_problems": [],
+    }
+    field_cache: dict = {}  # ノートタイプごとのフィールド解決結果
+    chunk_size = max(1, chunk_size)
+
+    for start in range(0, len(nids), chunk_size):
+        if budget and budget.exceeded():
+            report["remaining"].extend(nids[start:])
+            break
+
+        notes = {}
+        jobs = []
+        for nid in nids[start:start + chunk_size]:
+            note = col.get_note(nid)
+            # fan-out（03_fanout_fields）では1ノートから言語ごとのジョブができる
+            note_jobs, err = _prepare_note_jobs(note, cfg, field_cache)
+            if not note_jobs:
+                report["skipped"] += 1
+                continue
+            notes[int(note.id)] = note
+            jobs.extend(note_jobs)
+
+        results, remaining = _run_jobs(jobs, cfg, workers=workers, budget=budget, stats=report["stats"])
+        report["remaining"].extend(dict.fromkeys(job["nid"] for job in remaining))
+
+        # 集計はノート単位（fan-out で1ノートに複数フィールド書いても1件）
+        changed = {}
+        failed = set()
+        for job, html, err in results:
+            if not html:
+                failed.add(job["nid"])
+                print(f"nid {job['nid']}: {err}", file=sys.stderr)
+                continue
+            note = notes[job["nid"]]
+            ok, _err = _apply_html_to_note_fields(note, job["e_field"], html, job["behavior"], job["sep"])
+            if ok:
+                changed[job["nid"]] = note
+
+        done = {job["nid"] for job, _html, _err in results}
+        report["errors"] += len(failed)
+        report["generated"] += len(changed.keys() - failed)
+        report["skipped"] += len(done - failed - changed.keys())
+        if changed:
+            col.update_notes(list(changed.values()))
+        print(f"{min(start + chunk_size, len(nids))}/{len(nids)} notes processed", file=sys.stderr)
+
+    # 未知の言語コードなど、設定の問題はノートタイプごとに1回だけ出す
+    report["config_problems"] = sorted({e for fields in field_cache.values() for e in fields["fanout_errors"]})
+    return report
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="AI Card Explainer: headless batch generation")
+    ap.add_argument("collection", help="path to a .anki2 collection or an .apkg package")
+    ap.add_argument("--search", default="", help="Anki search query (default: all notes)")
+    ap.add_argument("--config", help="JSON file with config overrides (or the add-on's meta.json)")
+    ap.add_argument("--output", help="output .apkg (only for .apkg input; default: <name>.explained.apkg)")
+    ap.add_argument("--limit", type=int, default=0, help="max notes to process (0 = no limit)")
+    ap.add_argument("--workers", type=int, default=4, help="concurrent API requests")
+    ap.add_argument("--chunk-size", type=int, default=100, help="notes written back per update")
+    ap.add_argument("--max-tokens", type=int, help="stop after this many tokens (overrides 07_budget_max_tokens)")
+    ap.add_argument("--max-cost", type=float, help="stop after this estimated spend in USD (07_budget_max_cost_usd)")
+    ap.add_argument("--max-minutes", type=float, help="stop after this many minutes (07_budget_max_minutes)")
+    ap.add_argument("--max-error-rate", type=float, help="stop above this error rate, 0-1 (07_budget_max_error_rate)")
+    ap.add_argument("--remaining-file", help="write unprocessed nids here (one per line) when a budget stops the run")
+    args = ap.parse_args(argv)
+    # Collection() は存在しないパスに空のコレクションを作ってしまうので先に確認する
+    if not os.path.isfile(args.collection):
+        ap.error(f"collection not found: {args.collection}")
+
+    cfg = _load_config(args.config)
+    for key, value in (
+        ("07_budget_max_tokens", args.max_tokens),
+        ("07_budget_max_cost_usd", args.max_cost),
+        ("07_budget_max_minutes", args.max_minutes),
+        ("07_budget_max_error_rate", args.max_error_rate),
+    ):
+        if value is not None:
+            cfg[key] = value
+    budget = RunBudget(cfg)
+
+    is_apkg = args.collection.lower().endswith(".apkg")
+    workdir = tempfile.mkdtemp(prefix="ai-explainer-")
+    try:
+        col = _open_collection(args.collection, workdir)
+        try:
+            report = run_batch(col, cfg, args.search, args.limit, args.workers, args.chunk_size, budget)
+            if is_apkg:
+                out = args.output or os.path.splitext(args.collection)[0] + ".explained.apkg"
+                _export_package(col, out)
+                print(f"Wrote {out}", file=sys.stderr)
+        finally:
+            col.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(
+        "AI explanation batch finished.\n"
+        f"Notes: {report['total']}\n"
+        f"Generated: {report['generated']}\n"
+        f"Skipped: {report['skipped']}\n"
+        f"Errors: {report['errors']}\n"
+        f"Repaired locally: {report['stats'].get('repaired', 0)}\n"
+        f"Re-requested: {report['stats'].get('rerequested', 0)}\n"
+        f"Deduplicated: {report['stats'].get('deduped', 0)}\n"
+        f"{budget.summary()}"
+    )
+    for problem in report["config_problems"]:
+        print(f"Config problem: {problem}")
+    remaining = report["remaining"]
+    if remaining:
+        print(f"Stopped early: {budget.stop_reason}")
+        print(f"Remaining (not processed): {len(remaining)}")
+        print("nid:" + ",".join(str(nid) for nid in remaining))
+        if args.remaining_file:
+            with open(args.remaining_file, "w", encoding="utf-8") as f:
+                f.write("".join(f"{nid}\n" for nid in remaining))
+        return 2
+    return 1 if report["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
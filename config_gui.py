@@ -1,6 +1,7 @@
 # config_gui.py
 from __future__ import annotations
 
+import json
 from typing import Any, Dict, Optional, Callable
 
 from aqt import mw
@@ -14,18 +15,22 @@ DEFAULT_CONFIG: AddonConfig = {
     "01_provider": "gemini",
     "01_openai_api_key": "",
     "01_openai_model": "gpt-4o-mini",
+    "01_openai_base_url": "",
     "01_gemini_api_key": "",
     "01_gemini_model": "gemini-2.5-flash-lite",
 
     "02_question_field": "Front",
     "02_answer_field": "Back",
     "02_explanation_field": "Explanation",
+    "02_note_type_fields": {},
 
     "03_language": "en",
     "03_domain": "general",  
     "03_audience": "general",
     "03_explanation_style": "definition_and_mechanism",
     "03_target_length_chars": 260,
+    "03_fanout_fields": {},
+    "03_fanout_mode": "parallel",
 
     "04_on_existing_behavior": "append",
     "04_append_separator": "\n<hr>\n",
@@ -33,6 +38,20 @@ DEFAULT_CONFIG: AddonConfig = {
 
     "05_max_notes_per_run": 50,
     "05_review_shortcut": "Ctrl+Shift+L",
+
+    "06_repair_html": True,
+    "06_max_rerequests": 1,
+
+    "07_budget_max_tokens": 0,
+    "07_budget_max_cost_usd": 0.0,
+    "07_budget_max_minutes": 0.0,
+    "07_budget_max_error_rate": 0.0,
+    "07_price_input_per_1m_tokens": 0.0,
+    "07_price_output_per_1m_tokens": 0.0,
+
+    "08_soak_test_menu": False,
+    "08_soak_latency_ms": 300,
+    "08_soak_error_rate": 0.02,
 }
 
 
@@ -95,8 +114,13 @@ class ExplainerConfigDialog(QDialog):
         self.openai_model.setPlaceholderText("e.g. gpt-4o-mini")
         self.openai_model.setMinimumWidth(520)
 
+        self.openai_base_url = QLineEdit()
+        self.openai_base_url.setPlaceholderText("If empty: https://api.openai.com/v1 (OpenAI-compatible endpoints)")
+        self.openai_base_url.setMinimumWidth(520)
+
         openai_form.addRow("API key", self.openai_key)
         openai_form.addRow("Model", self.openai_model)
+        openai_form.addRow("Base URL", self.openai_base_url)
 
         # Gemini
         gemini_box = QGroupBox("Gemini")
@@ -130,6 +154,16 @@ class ExplainerConfigDialog(QDialog):
         form_f.addRow("Answer field", self.a_field)
         form_f.addRow("Explanation field", self.e_field)
 
+        self.nt_fields = QPlainTextEdit()
+        self.nt_fields.setMinimumHeight(140)
+        self.nt_fields.setPlaceholderText(
+            '{\n'
+            '  "Cloze": {"question": "Text", "answer": ["Back Extra"], "explanation": "Explanation"}\n'
+            '}'
+        )
+        form_f.addRow("Per note type (JSON)", self.nt_fields)
+        form_f.addRow("", QLabel("Note types not listed here use the fields above."))
+
         # --- Tab: Output ---
         tab_out = QWidget(self)
         self.tabs.addTab(tab_out, "Output")
@@ -171,6 +205,17 @@ class ExplainerConfigDialog(QDialog):
         self.target_len.setRange(80, 800)
         form_o.addRow("Target length (chars)", self.target_len)
 
+        self.fanout_fields = QPlainTextEdit()
+        self.fanout_fields.setMinimumHeight(90)
+        self.fanout_fields.setPlaceholderText('{"en": "Explanation", "ja": "Explanation (JA)"}')
+        form_o.addRow("Multi-language fields (JSON)", self.fanout_fields)
+        form_o.addRow("", QLabel("Batch runs only. When set, Language and Explanation field are ignored for batches."))
+
+        self.fanout_mode = QComboBox()
+        self.fanout_mode.addItem("Parallel (one request per language)", "parallel")
+        self.fanout_mode.addItem("Combined (one request for all languages)", "combined")
+        form_o.addRow("Multi-language mode", self.fanout_mode)
+
         # --- Tab: Behavior / Batch ---
         tab_b = QWidget(self)
         self.tabs.addTab(tab_b, "Behavior")
@@ -197,6 +242,53 @@ class ExplainerConfigDialog(QDialog):
         self.shortcut = QKeySequenceEdit()
         form_b.addRow("Review shortcut", self.shortcut)
 
+        self.repair_html = QCheckBox("Validate and repair generated HTML")
+        form_b.addRow("HTML repair", self.repair_html)
+
+        self.max_rerequests = QSpinBox()
+        self.max_rerequests.setRange(0, 5)
+        form_b.addRow("Re-requests when repair fails", self.max_rerequests)
+
+        # --- Tab: Budget ---
+        tab_budget = QWidget(self)
+        self.tabs.addTab(tab_budget, "Budget")
+        form_bu = QFormLayout(tab_budget)
+        form_bu.addRow(QLabel("Limits for one batch run (0 = no limit). The run stops starting new notes when one is reached."))
+
+        self.budget_tokens = QSpinBox()
+        self.budget_tokens.setRange(0, 100_000_000)
+        self.budget_tokens.setSingleStep(10_000)
+        form_bu.addRow("Max tokens", self.budget_tokens)
+
+        self.budget_cost = QDoubleSpinBox()
+        self.budget_cost.setRange(0, 10_000)
+        self.budget_cost.setDecimals(2)
+        self.budget_cost.setPrefix("$ ")
+        form_bu.addRow("Max estimated cost", self.budget_cost)
+
+        self.budget_minutes = QDoubleSpinBox()
+        self.budget_minutes.setRange(0, 24 * 60)
+        self.budget_minutes.setDecimals(1)
+        form_bu.addRow("Max minutes", self.budget_minutes)
+
+        self.budget_error_rate = QDoubleSpinBox()
+        self.budget_error_rate.setRange(0, 1)
+        self.budget_error_rate.setDecimals(2)
+        self.budget_error_rate.setSingleStep(0.05)
+        form_bu.addRow("Max error rate (0–1)", self.budget_error_rate)
+
+        self.price_in = QDoubleSpinBox()
+        self.price_in.setRange(0, 1000)
+        self.price_in.setDecimals(3)
+        self.price_in.setPrefix("$ ")
+        form_bu.addRow("Input price / 1M tokens", self.price_in)
+
+        self.price_out = QDoubleSpinBox()
+        self.price_out.setRange(0, 1000)
+        self.price_out.setDecimals(3)
+        self.price_out.setPrefix("$ ")
+        form_bu.addRow("Output price / 1M tokens", self.price_out)
+
         # live UI tweaks
         self.on_exists.currentIndexChanged.connect(self._sync_append_enabled)
 
@@ -223,6 +315,7 @@ class ExplainerConfigDialog(QDialog):
         self._set_combo_by_data(self.provider, cfg.get("01_provider", "openai"))
         self.openai_key.setText(str(cfg.get("01_openai_api_key", "")) or "")
         self.openai_model.setText(str(cfg.get("01_openai_model", DEFAULT_CONFIG["01_openai_model"])) or "")
+        self.openai_base_url.setText(str(cfg.get("01_openai_base_url", "")) or "")
         self.gemini_key.setText(str(cfg.get("01_gemini_api_key", "")) or "")
         self.gemini_model.setText(str(cfg.get("01_gemini_model", DEFAULT_CONFIG["01_gemini_model"])) or "")
 
@@ -230,6 +323,8 @@ class ExplainerConfigDialog(QDialog):
         self.q_field.setText(str(cfg.get("02_question_field", "Front")) or "Front")
         self.a_field.setText(str(cfg.get("02_answer_field", "Back")) or "Back")
         self.e_field.setText(str(cfg.get("02_explanation_field", "Explanation")) or "Explanation")
+        nt_fields = cfg.get("02_note_type_fields") or {}
+        self.nt_fields.setPlainText(json.dumps(nt_fields, ensure_ascii=False, indent=2) if nt_fields else "")
 
         # Output
         # new key preferred; fallback to legacy key
@@ -239,6 +334,9 @@ class ExplainerConfigDialog(QDialog):
         self._set_combo_by_data(self.language, cfg.get("03_language", "ja"))
         self._set_combo_by_data(self.style, cfg.get("03_explanation_style", "definition_and_mechanism"))
         self.target_len.setValue(int(cfg.get("03_target_length_chars", 260) or 260))
+        fanout = cfg.get("03_fanout_fields") or {}
+        self.fanout_fields.setPlainText(json.dumps(fanout, ensure_ascii=False) if fanout else "")
+        self._set_combo_by_data(self.fanout_mode, cfg.get("03_fanout_mode", "parallel"))
 
         # Behavior
         self._set_combo_by_data(self.on_exists, cfg.get("04_on_existing_behavior", "skip"))
@@ -249,6 +347,17 @@ class ExplainerConfigDialog(QDialog):
         seq = QKeySequence(str(cfg.get("05_review_shortcut", "Ctrl+Shift+L") or "Ctrl+Shift+L"))
         self.shortcut.setKeySequence(seq)
 
+        self.repair_html.setChecked(bool(cfg.get("06_repair_html", True)))
+        self.max_rerequests.setValue(int(cfg.get("06_max_rerequests", 1) or 0))
+
+        # Budget
+        self.budget_tokens.setValue(int(cfg.get("07_budget_max_tokens", 0) or 0))
+        self.budget_cost.setValue(float(cfg.get("07_budget_max_cost_usd", 0) or 0))
+        self.budget_minutes.setValue(float(cfg.get("07_budget_max_minutes", 0) or 0))
+        self.budget_error_rate.setValue(float(cfg.get("07_budget_max_error_rate", 0) or 0))
+        self.price_in.setValue(float(cfg.get("07_price_input_per_1m_tokens", 0) or 0))
+        self.price_out.setValue(float(cfg.get("07_price_output_per_1m_tokens", 0) or 0))
+
         self._sync_append_enabled()
 
     def _collect_from_ui(self) -> AddonConfig:
@@ -258,6 +367,7 @@ class ExplainerConfigDialog(QDialog):
 
         cfg["01_openai_api_key"] = self.openai_key.text().strip()
         cfg["01_openai_model"] = self.openai_model.text().strip() or DEFAULT_CONFIG["01_openai_model"]
+        cfg["01_openai_base_url"] = self.openai_base_url.text().strip()
 
         cfg["01_gemini_api_key"] = self.gemini_key.text().strip()
         cfg["01_gemini_model"] = self.gemini_model.text().strip() or DEFAULT_CONFIG["01_gemini_model"]
@@ -265,6 +375,7 @@ class ExplainerConfigDialog(QDialog):
         cfg["02_question_field"] = self.q_field.text().strip() or "Front"
         cfg["02_answer_field"] = self.a_field.text().strip() or "Back"
         cfg["02_explanation_field"] = self.e_field.text().strip() or "Explanation"
+        cfg["02_note_type_fields"] = self._parse_note_type_fields(self.nt_fields.toPlainText())
 
         cfg["03_language"] = self.language.currentData()
         cfg["03_domain"] = self.domain.currentData()
@@ -272,6 +383,8 @@ class ExplainerConfigDialog(QDialog):
         cfg["03_audience"] = cfg["03_domain"]
         cfg["03_explanation_style"] = self.style.currentData()
         cfg["03_target_length_chars"] = int(self.target_len.value())
+        cfg["03_fanout_fields"] = self._parse_fanout_fields(self.fanout_fields.toPlainText())
+        cfg["03_fanout_mode"] = self.fanout_mode.currentData()
 
         cfg["04_on_existing_behavior"] = self.on_exists.currentData()
         cfg["04_append_separator"] = self.append_sep.toPlainText()
@@ -284,8 +397,53 @@ class ExplainerConfigDialog(QDialog):
         ks = self.shortcut.keySequence()
         cfg["05_review_shortcut"] = ks.toString() or DEFAULT_CONFIG["05_review_shortcut"]
 
+        cfg["06_repair_html"] = self.repair_html.isChecked()
+        cfg["06_max_rerequests"] = int(self.max_rerequests.value())
+
+        cfg["07_budget_max_tokens"] = int(self.budget_tokens.value())
+        cfg["07_budget_max_cost_usd"] = float(self.budget_cost.value())
+        cfg["07_budget_max_minutes"] = float(self.budget_minutes.value())
+        cfg["07_budget_max_error_rate"] = float(self.budget_error_rate.value())
+        cfg["07_price_input_per_1m_tokens"] = float(self.price_in.value())
+        cfg["07_price_output_per_1m_tokens"] = float(self.price_out.value())
+
         return cfg
 
+    @staticmethod
+    def _parse_note_type_fields(text: str) -> AddonConfig:
+        text = text.strip()
+        if not text:
+            return {}
+        data = json.loads(text)
+        if not isinstance(data, dict) or not all(isinstance(v, dict) for v in data.values()):
+            raise ValueError('Per note type: expected {"Note type": {"question": ..., "answer": ..., "explanation": ...}}')
+        for name, mapping in data.items():
+            if "fanout" in mapping:
+                ExplainerConfigDialog._check_fanout_fields(mapping["fanout"], f"Per note type '{name}': fanout")
+        return data
+
+    @staticmethod
+    def _parse_fanout_fields(text: str) -> AddonConfig:
+        text = text.strip()
+        if not text:
+            return {}
+        data = json.loads(text)
+        ExplainerConfigDialog._check_fanout_fields(data, "Multi-language fields")
+        return data
+
+    @staticmethod
+    def _check_fanout_fields(data: Any, label: str) -> None:
+        from .core import LANG_MAP
+
+        if not isinstance(data, dict) or not all(isinstance(v, str) for v in data.values()):
+            raise ValueError(f'{label}: expected {{"language code": "Field name"}}')
+        # 未知のコードは英語で生成されてしまうので保存させない
+        unknown = [k for k in data if str(k).lower().strip() not in LANG_MAP]
+        if unknown:
+            raise ValueError(
+                f"{label}: unknown language code(s) {', '.join(unknown)} (supported: {', '.join(LANG_MAP)})"
+            )
+
     def _write_config(self, cfg: AddonConfig) -> None:
         mw.addonManager.writeConfig(self.addon_id, cfg)
         self.cfg = cfg
@@ -297,14 +455,20 @@ class ExplainerConfigDialog(QDialog):
                 # 反映失敗しても保存自体は成功させる
                 pass
 
-    def _on_apply(self) -> None:
-        cfg = self._collect_from_ui()
+    def _on_apply(self) -> bool:
+        try:
+            cfg = self._collect_from_ui()
+        except ValueError as e:
+            # json.JSONDecodeError も ValueError
+            showWarning(f"Invalid settings:\n{e}", parent=self)
+            return False
         self._write_config(cfg)
         tooltip("Settings saved.")
+        return True
 
     def _on_ok(self) -> None:
-        self._on_apply()
-        self.accept()
+        if self._on_apply():
+            self.accept()
 
     def _on_defaults(self) -> None:
         self.cfg = dict(DEFAULT_CONFIG)
@@ -0,0 +1,721 @@
+# core.py
+from __future__ import annotations
+
+import os
+import re
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Optional, Dict, Any
+
+from .html_repair import repair_html
+
+# aqt / mw には依存しない（GUI とヘッドレスの cli.py の両方から使う）
+
+AddonConfig = Dict[str, Any]
+
+
+# ==============================
+# Config helper
+# ==============================
+
+# Helpers to fetch numbered keys
+def cfg_get(cfg: dict, key: str, default=None):
+    return cfg.get(key, default)
+
+
+def _target_len(cfg: AddonConfig) -> int:
+    target_len = int(cfg_get(cfg, "03_target_length_chars", 260))
+    return max(80, min(800, target_len))
+
+
+def _bump(stats: Optional[dict], key: str, n: int = 1) -> None:
+    if stats is not None:
+        stats[key] = stats.get(key, 0) + n
+
+
+# ==============================
+# Prompt building
+# ==============================
+
+LANG_MAP = {
+    "ja": "Japanese",
+    "en": "English",
+    "de": "German",
+    "fr": "French",
+    "es": "Spanish",
+    "zh": "Chinese",
+    "ko": "Korean",
+    "it": "Italian",
+    "pt": "Portuguese",
+    "ru": "Russian",
+    "ar": "Arabic",
+}
+
+
+def _build_prompts(
+    question: str,
+    answer: str,
+    cfg: AddonConfig,
+    languages: Optional[list[str]] = None,
+) -> tuple[str, str]:
+    # languages を渡すと、1回のリクエストで複数言語を書かせるプロンプトにする（fan-out の combined モード）
+    # --- Domain (new) with backward compat ---
+    # new key: 03_domain = "medical" | "general"
+    # old key: 03_audience (legacy) - used only if 03_domain is missing
+    domain = cfg_get(cfg, "03_domain", None)
+    if not domain:
+        domain = cfg_get(cfg, "03_audience", "general")
+    domain = str(domain).lower().strip()
+    if domain not in ("medical", "general"):
+        domain = "medical"
+
+    # --- Language ---
+    language = str(cfg_get(cfg, "03_language", "ja") or "ja").lower().strip()
+    lang_label = LANG_MAP.get(language, "English")
+
+    # --- Style / Length ---
+    style = cfg_get(cfg, "03_explanation_style", "definition_and_mechanism")
+    target_len = _target_len(cfg)
+
+    # --- System prompt: domain switch (English only; output language is controlled below) ---
+    if domain == "medical":
+        system_prompt = (
+            "You are an expert medical tutor. "
+            "Write an explanation suitable for medical/health-science students. "
+            "Be accurate. Avoid unnecessary chatter."
+        )
+    else:
+        system_prompt = (
+            "You are an expert tutor across many subjects. "
+            "Write an explanation suitable for learners. "
+            "Be accurate, clear, and avoid unnecessary digressions."
+        )
+
+    # --- Style instructions ---
+    lines: list[str] = []
+    lines.append("1. Summarize the definition or overall idea first.")
+
+    if style in ("definition_and_mechanism", "full"):
+        if domain == "medical":
+            lines.append("2. Describe the mechanism/pathophysiology.")
+        else:
+            lines.append("2. Explain the reasoning, cause-effect, or the key concept.")
+
+    if style == "full":
+        if domain == "medical":
+            lines.append("3. Add brief clinical notes (high-yield points).")
+        else:
+            lines.append("3. Add helpful context (examples, common pitfalls, or why it matters).")
+
+    lines.append(f"Target length: ~{target_len} characters.")
+
+    # --- User prompt: language + strict output constraints ---
+
+    q = (question or "").strip()
+    a = (answer or "").strip()
+
+    parts: list[str] = []
+    parts.append("Please write an explanation for this Anki card.")
+    parts.append("")
+
+    if q and a:
+        parts.append(f"Question:\n{q}\n")
+        parts.append(f"Answer:\n{a}\n")
+    elif q:
+        parts.append("Only the question is available (the answer field is empty or missing).")
+        parts.append(f"Question:\n{q}\n")
+        parts.append("Explain the concept being asked, and what kind of answer would be expected.")
+        parts.append("")
+    elif a:
+        parts.append("Only the answer is available (the question field is empty or missing).")
+        parts.append(f"Answer:\n{a}\n")
+        parts.append("Explain what this answer means, and typical contexts where it appears.")
+        parts.append("")
+
+    parts.append("\n".join(lines))
+    if languages:
+        labels = ", ".join(f"{LANG_MAP.get(lang, 'English')} ({lang})" for lang in languages)
+        parts.append(f"\nWrite the explanation once in EACH of these languages: {labels}.")
+        parts.append(
+            "Start each language version with a marker line of the form <!-- lang:CODE --> "
+            f"(for example <!-- lang:{languages[0]} -->) and put nothing else on that line."
+        )
+    else:
+        parts.append(f"\nThe output language MUST be {lang_label}.")
+    parts.append("Return HTML ONLY .")
+    parts.append("Do NOT wrap the output in markdown or code blocks.")
+    parts.append("Do NOT include ``` or ```html.")
+    if languages:
+        parts.append(f"Keep each language version around {target_len} characters.")
+    else:
+        parts.append(f"Keep the output around {target_len} characters.")
+
+    user_prompt = "\n".join(parts) + "\n"
+
+    return system_prompt, user_prompt
+
+
+# ==============================
+# API calls (OpenAI / Gemini)
+# ==============================
+
+def _call_openai(
+    api_key: str,
+    model: str,
+    system_prompt: str,
+    user_prompt: str,
+    stats: Optional[dict] = None,
+    max_tokens: int = 512,
+    base_url: str = "https://api.openai.com/v1",
+) -> str:
+    import requests  # uses Anki's bundled venv（初回呼び出し時に読み込む）
+
+    url = f"{base_url.rstrip('/')}/chat/completions"
+    headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
+    body = {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt},
+        ],
+        "temperature": 0.2,
+        "max_tokens": max_tokens,
+    }
+    r = requests.post(url, headers=headers, json=body, timeout=40)
+    r.raise_for_status()
+    data = r.json()
+    usage = data.get("usage") or {}
+    _bump(stats, "prompt_tokens", int(usage.get("prompt_tokens") or 0))
+    _bump(stats, "completion_tokens", int(usage.get("completion_tokens") or 0))
+    return data["choices"][0]["message"]["content"].strip()
+
+
+def _call_gemini(api_key: str, model: str, system_prompt: str, user_prompt: str, stats: Optional[dict] = None) -> str:
+    import requests  # uses Anki's bundled venv
+
+    url = f"https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent"
+    headers = {"Content-Type": "application/json", "x-goog-api-key": api_key}
+    body = {"contents": [{"parts": [{"text": system_prompt + "\n\n" + user_prompt}]}]}
+    r = requests.post(url, headers=headers, json=body, timeout=40)
+    r.raise_for_status()
+    data = r.json()
+    usage = data.get("usageMetadata") or {}
+    _bump(stats, "prompt_tokens", int(usage.get("promptTokenCount") or 0))
+    # thinking 系モデルの思考トークンも出力として課金される
+    _bump(stats, "completion_tokens", int(usage.get("candidatesTokenCount") or 0) + int(usage.get("thoughtsTokenCount") or 0))
+    parts = data["candidates"][0]["content"]["parts"]
+    return parts[0]["text"].strip()
+
+
+def _provider_settings(cfg: AddonConfig) -> tuple[str, Optional[str], str]:
+    provider = cfg_get(cfg, "01_provider", "openai")
+    if provider == "openai":
+        api_key = cfg_get(cfg, "01_openai_api_key") or os.getenv("OPENAI_API_KEY")
+        model = cfg_get(cfg, "01_openai_model", "gpt-4o-mini")
+    else:
+        api_key = cfg_get(cfg, "01_gemini_api_key") or os.getenv("GEMINI_API_KEY")
+        model = cfg_get(cfg, "01_gemini_model", "gemini-2.5-flash-lite")
+    return provider, api_key, model
+
+
+def _call_model(
+    cfg: AddonConfig,
+    api_key: str,
+    system_prompt: str,
+    user_prompt: str,
+    stats: Optional[dict] = None,
+    max_tokens: int = 512,
+) -> str:
+    provider, _key, model = _provider_settings(cfg)
+    if provider == "openai":
+        # 01_openai_base_url: OpenAI 互換のエンドポイント（soak テストのローカル偽プロバイダ等）
+        base_url = cfg_get(cfg, "01_openai_base_url", "") or "https://api.openai.com/v1"
+        return _call_openai(api_key, model, system_prompt, user_prompt, stats, max_tokens, base_url)
+    return _call_gemini(api_key, model, system_prompt, user_prompt, stats)
+
+
+# ==============================
+# Note jobs (field / behavior logic)
+# ==============================
+
+def _field_names(value) -> list[str]:
+    # "Front" / ["Front", "Extra"] のどちらでも書けるようにする
+    if isinstance(value, str):
+        return [value] if value.strip() else []
+    if isinstance(value, (list, tuple)):
+        return [str(v) for v in value if str(v).strip()]
+    return []
+
+
+def _resolve_note_fields(note, cfg: AddonConfig, cache: Optional[dict] = None) -> dict:
+    """
+    ノートタイプごとに使うフィールドを決める。
+
+    02_note_type_fields にノートタイプ名があればその設定を、なければ
+    02_question_field / 02_answer_field / 02_explanation_field を使う。
+    03_fanout_fields（言語 -> フィールド）も同じようにここで解決する。
+    フィールド名は大文字小文字を区別せずに照合し、存在するものだけ残す。
+    cache（mid -> 結果）を渡すと、同じノートタイプは1回だけ解決する。
+    """
+    mid = int(getattr(note, "mid", 0) or 0)
+    if cache is not None and mid in cache:
+        return cache[mid]
+
+    try:
+        nt_name = str(note.note_type()["name"])
+    except Exception:
+        nt_name = ""
+    # config.json を手で書き換えた場合に備えて型を確認し、おかしな項目は無視する
+    mappings = cfg_get(cfg, "02_note_type_fields", {})
+    mapping = mappings.get(nt_name) if isinstance(mappings, dict) else None
+    if not isinstance(mapping, dict):
+        mapping = {}
+
+    q_names = _field_names(mapping.get("question", cfg_get(cfg, "02_question_field", "Front")))
+    a_names = _field_names(mapping.get("answer", cfg_get(cfg, "02_answer_field", "Back")))
+    e_names = _field_names(mapping.get("explanation", cfg_get(cfg, "02_explanation_field", "Explanation")))
+
+    by_lower = {k.lower(): k for k in note.keys()}
+
+    def pick(names: list[str]) -> list[str]:
+        return [by_lower[n.lower()] for n in names if n.lower() in by_lower]
+
+    e_fields = pick(e_names)
+    # fan-out: 見つからないフィールドは None のまま残す（スキップ理由に使う）
+    fanout = mapping.get("fanout")
+    if not isinstance(fanout, dict):
+        fanout = cfg_get(cfg, "03_fanout_fields", {})
+    if not isinstance(fanout, dict):
+        fanout = {}
+    # 未知の言語コードは英語で生成してしまわないように外し、理由を残す
+    fanout_targets = []
+    fanout_errors = []
+    for lang, name in fanout.items():
+        if not (isinstance(name, str) and name.strip()):
+            continue
+        code = str(lang).lower().strip()
+        if code not in LANG_MAP:
+            fanout_errors.append(
+                f"Unknown language code '{lang}' for field '{name}' (supported: {', '.join(LANG_MAP)})."
+            )
+            continue
+        fanout_targets.append((code, name, by_lower.get(name.lower())))
+    resolved = {
+        "note_type": nt_name,
+        "question": pick(q_names),
+        "answer": pick(a_names),
+        "explanation": e_fields[0] if e_fields else None,
+        "fanout": fanout_targets,
+        "fanout_errors": fanout_errors,
+    }
+    if cache is not None:
+        cache[mid] = resolved
+    return resolved
+
+
+def _read_question_answer(note, fields: dict) -> tuple[str, str]:
+    # フィールドが存在しない場合も即スキップにせず、存在する方だけ使う
+    # 複数フィールドを指定した場合は空でないものを改行でつなぐ
+    question = "\n".join(v for v in ((note[f] or "").strip() for f in fields["question"]) if v)
+    answer = "\n".join(v for v in ((note[f] or "").strip() for f in fields["answer"]) if v)
+    return question, answer
+
+
+def _prepare_note_job_from_note(
+    note,
+    cfg: AddonConfig,
+    field_cache: Optional[dict] = None,
+) -> tuple[Optional[dict], Optional[str]]:
+    fields = _resolve_note_fields(note, cfg, field_cache)
+    question, answer = _read_question_answer(note, fields)
+
+    # 両方空なら無理
+    if (not question) and (not answer):
+        return None, "Question and answer are both empty (or missing)."
+
+    e_field = fields["explanation"]
+    if not e_field:
+        return None, f"Explanation field does not exist (note type: {fields['note_type'] or '?'})."
+    existing_raw = note[e_field] or ""
+    behavior = cfg_get(cfg, "04_on_existing_behavior", "skip")
+    if existing_raw.strip() and behavior == "skip":
+        return None, "Explanation already exists."
+    sep = cfg_get(cfg, "04_append_separator", "\n<hr>\n")
+    return {
+        "nid": int(note.id),
+        "e_field": e_field,
+        "question": question,
+        "answer": answer,
+        "behavior": behavior,
+        "sep": sep,
+    }, None
+
+
+def _prepare_note_jobs(
+    note,
+    cfg: AddonConfig,
+    field_cache: Optional[dict] = None,
+) -> tuple[list[dict], Optional[str]]:
+    """
+    バッチ用：1ノートから生成ジョブを作る（ノートは1回だけ読む）。
+
+    03_fanout_fields が空なら _prepare_note_job_from_note と同じ1ジョブ。
+    設定されていれば言語ごとに "language" 付きのジョブを作る。
+    03_fanout_mode が "combined" なら全言語をまとめた1ジョブ（"fanout" に各言語の出力先）。
+    未知の言語コードがあればその言語は作らず、ジョブがあっても err にその理由を返す。
+    """
+    fields = _resolve_note_fields(note, cfg, field_cache)
+    lang_err = fields["fanout_errors"][0] if fields["fanout_errors"] else None
+    if not fields["fanout"]:
+        if lang_err:
+            # fan-out のつもりの設定なので、既定の1言語にはフォールバックしない
+            return [], lang_err
+        job, err = _prepare_note_job_from_note(note, cfg, field_cache)
+        return ([job] if job else []), err
+
+    question, answer = _read_question_answer(note, fields)
+    if (not question) and (not answer):
+        return [], "Question and answer are both empty (or missing)."
+
+    behavior = cfg_get(cfg, "04_on_existing_behavior", "skip")
+    targets: list[dict] = []
+    err: Optional[str] = None
+    for lang, name, e_field in fields["fanout"]:
+        if not e_field:
+            err = f"Explanation field '{name}' does not exist (note type: {fields['note_type'] or '?'})."
+            continue
+        if (note[e_field] or "").strip() and behavior == "skip":
+            err = "Explanation already exists."
+            continue
+        targets.append({"language": lang, "e_field": e_field})
+    if not targets:
+        return [], lang_err or err
+
+    base = {
+        "nid": int(note.id),
+        "question": question,
+        "answer": answer,
+        "behavior": behavior,
+        "sep": cfg_get(cfg, "04_append_separator", "\n<hr>\n"),
+    }
+    if cfg_get(cfg, "03_fanout_mode", "parallel") == "combined" and len(targets) > 1:
+        return [dict(base, **targets[0], fanout=targets)], lang_err
+    return [dict(base, **t) for t in targets], lang_err
+
+
+def _apply_html_to_note_fields(note, e_field: str, html: str, behavior: str, sep: str) -> tuple[bool, Optional[str]]:
+    # フィールドを書き換えるだけ（保存は呼び出し側：flush / col.update_notes）
+    existing_raw = note[e_field] or ""
+    existing = existing_raw.strip()
+    if existing and behavior == "skip":
+        return False, "Explanation already exists."
+    if existing and behavior == "append":
+        note[e_field] = existing_raw + (sep or "\n<hr>\n") + html
+    else:
+        note[e_field] = html
+    return True, None
+
+
+# ==============================
+# Generate explanation HTML
+# ==============================
+
+_RE_WHOLE_FENCE = re.compile(
+    r"^\s*```(?:\s*(?P<lang>[a-zA-Z0-9_-]+))?\s*\n(?P<body>.*)\n```\s*$",
+    re.DOTALL,
+)
+
+def _strip_markdown_fences(s: str) -> str:
+    if not s:
+        return ""
+    t = s.strip()
+
+    # 「全文が1つの ```...``` で包まれている」場合だけ剥がす
+    m = _RE_WHOLE_FENCE.match(t)
+    if m:
+        body = (m.group("body") or "").strip()
+        lang = (m.group("lang") or "").lower()
+
+        # 任意：HTMLっぽくない言語のときは剥がさない（保守的）
+        # 例: json / python が来たらそのまま返す
+        if lang and lang not in ("html", "htm", "xml"):
+            return t
+
+        return body
+
+    # それ以外は何もしない（消しすぎ防止）
+    return t
+
+
+def _generate_html(
+    question: str,
+    answer: str,
+    cfg: AddonConfig,
+    stats: Optional[dict] = None,
+) -> tuple[Optional[str], Optional[str]]:
+    # stats を渡すと "repaired" / "rerequested" の回数と
+    # "prompt_tokens" / "completion_tokens"（API の usage）を数える（バッチのレポート・予算用）
+    system_prompt, user_prompt = _build_prompts(question, answer, cfg)
+    _provider, api_key, _model = _provider_settings(cfg)
+    if not api_key:
+        return None, "API key not set."
+
+    max_rerequests = max(0, int(cfg_get(cfg, "06_max_rerequests", 1)))
+
+    try:
+        for attempt in range(max_rerequests + 1):
+            if attempt:
+                _bump(stats, "rerequested")
+            raw = _call_model(cfg, api_key, system_prompt, user_prompt, stats)
+
+            # まずローカルで修復し、直せないときだけモデルに再リクエストする
+            html_out = _postprocess_html(raw, cfg, stats)
+            if html_out is not None:
+                return html_out, None
+
+        return None, "Invalid HTML output (local repair failed)."
+
+    except Exception as e:
+        traceback.print_exc()
+        return None, f"API error: {e}"
+
+
+def _postprocess_html(raw: str, cfg: AddonConfig, stats: Optional[dict] = None) -> Optional[str]:
+    # None = ローカルでは直せなかった（呼び出し側で再リクエスト）
+    html_out = _strip_markdown_fences(raw)
+    if not bool(cfg_get(cfg, "06_repair_html", True)):
+        return html_out
+    fixed, repairs = repair_html(html_out, _target_len(cfg))
+    if fixed and repairs:
+        _bump(stats, "repaired")
+    return fixed
+
+
+_RE_LANG_MARKER = re.compile(r"<!--\s*lang\s*:\s*([a-zA-Z_-]+)\s*-->")
+
+
+def _split_language_sections(raw: str) -> dict[str, str]:
+    # "<!-- lang:ja --> ... <!-- lang:de --> ..." を言語ごとに分ける
+    pieces = _RE_LANG_MARKER.split(raw or "")
+    sections: dict[str, str] = {}
+    for i in range(1, len(pieces) - 1, 2):
+        lang = pieces[i].lower()
+        body = pieces[i + 1].strip()
+        if body and lang not in sections:
+            sections[lang] = body
+    return sections
+
+
+def _generate_html_multi(
+    question: str,
+    answer: str,
+    cfg: AddonConfig,
+    languages: list[str],
+    stats: Optional[dict] = None,
+) -> list[tuple[str, Optional[str], Optional[str]]]:
+    """
+    1回のリクエストで全言語分を生成し、マーカーで分割する。
+
+    戻り値は [(language, html, err), ...]。欠けた言語・直せなかった言語だけ
+    言語ごとのリクエスト（_generate_html）でやり直す。
+    """
+    system_prompt, user_prompt = _build_prompts(question, answer, cfg, languages=languages)
+    _provider, api_key, _model = _provider_settings(cfg)
+    if not api_key:
+        return [(lang, None, "API key not set.") for lang in languages]
+
+    try:
+        raw = _call_model(cfg, api_key, system_prompt, user_prompt, stats, max_tokens=512 * len(languages))
+    except Exception as e:
+        traceback.print_exc()
+        return [(lang, None, f"API error: {e}") for lang in languages]
+
+    sections = _split_language_sections(raw)
+    out: list[tuple[str, Optional[str], Optional[str]]] = []
+    for lang in languages:
+        html_out = _postprocess_html(sections[lang], cfg, stats) if lang in sections else None
+        if html_out is None:
+            _bump(stats, "rerequested")
+            html_out, err = _generate_html(question, answer, dict(cfg, **{"03_language": lang}), stats)
+            out.append((lang, html_out, err))
+        else:
+            out.append((lang, html_out, None))
+    return out
+
+
+
+# ==============================
+# Batch runner with budget
+# ==============================
+
+# エラー率の判定はこの件数のノートが終わってから（最初の1件の失敗で止めない）
+ERROR_RATE_MIN_NOTES = 5
+
+
+class RunBudget:
+    """
+    1回のバッチの上限（トークン / 推定コスト / 経過時間 / エラー率）。
+
+    07_budget_* が 0 の項目は無制限。exceeded() が理由を返したら
+    新しいジョブは投げず、実行中のものだけ終わらせる。
+    """
+
+    def __init__(self, cfg: AddonConfig) -> None:
+        self.max_tokens = int(cfg_get(cfg, "07_budget_max_tokens", 0) or 0)
+        self.max_cost = float(cfg_get(cfg, "07_budget_max_cost_usd", 0) or 0)
+        self.max_seconds = float(cfg_get(cfg, "07_budget_max_minutes", 0) or 0) * 60
+        self.max_error_rate = float(cfg_get(cfg, "07_budget_max_error_rate", 0) or 0)
+        self.price_in = float(cfg_get(cfg, "07_price_input_per_1m_tokens", 0) or 0)
+        self.price_out = float(cfg_get(cfg, "07_price_output_per_1m_tokens", 0) or 0)
+
+        self.started = time.monotonic()
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        # エラー率はノート単位（fan-out の言語ごとのジョブや、重複をまとめたジョブでも1ノート1件）
+        self.done_nids: set = set()
+        self.failed_nids: set = set()
+        self.stop_reason: Optional[str] = None
+        self._lock = threading.Lock()
+
+    @property
+    def tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    @property
+    def cost(self) -> float:
+        return (self.prompt_tokens * self.price_in + self.completion_tokens * self.price_out) / 1_000_000
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    @property
+    def done(self) -> int:
+        return len(self.done_nids)
+
+    @property
+    def errors(self) -> int:
+        # 1言語でも失敗したノートはエラーに数える
+        return len(self.failed_nids)
+
+    def record(self, stats: dict, results: list[tuple[dict, Optional[str], Optional[str]]]) -> None:
+        # results は _run_jobs の (job, html, err)（書き込み先ごと）
+        with self._lock:
+            self.prompt_tokens += int(stats.get("prompt_tokens", 0))
+            self.completion_tokens += int(stats.get("completion_tokens", 0))
+            for job, html, _err in results:
+                self.done_nids.add(job["nid"])
+                if not html:
+                    self.failed_nids.add(job["nid"])
+
+    def exceeded(self) -> Optional[str]:
+        with self._lock:
+            if self.stop_reason:
+                return self.stop_reason
+            if self.max_tokens and self.tokens >= self.max_tokens:
+                self.stop_reason = f"token budget reached ({self.tokens} / {self.max_tokens})"
+            elif self.max_cost and self.cost >= self.max_cost:
+                self.stop_reason = f"cost budget reached (${self.cost:.4f} / ${self.max_cost:.4f})"
+            elif self.max_seconds and self.elapsed >= self.max_seconds:
+                self.stop_reason = f"time budget reached ({self.elapsed / 60:.1f} / {self.max_seconds / 60:.1f} min)"
+            elif (
+                self.max_error_rate
+                and self.done >= ERROR_RATE_MIN_NOTES
+                and self.errors / self.done > self.max_error_rate
+            ):
+                self.stop_reason = f"error rate too high ({self.errors}/{self.done})"
+            return self.stop_reason
+
+    def summary(self) -> str:
+        cost = f"${self.cost:.4f}" if (self.price_in or self.price_out) else "n/a (prices not set)"
+        return (
+            f"Tokens: {self.tokens} (in {self.prompt_tokens} / out {self.completion_tokens})\n"
+            f"Estimated cost: {cost}\n"
+            f"Elapsed: {self.elapsed:.1f} s"
+        )
+
+
+def _generate_for_job(job: dict, cfg: AddonConfig) -> tuple[list[tuple[Optional[str], Optional[str], Optional[str]]], dict]:
+    # ジョブごとに stats を分けて、呼び出し側でまとめる（スレッドセーフにするため）
+    # 戻り値の1つ目は [(language, html, err), ...]（通常は1要素、combined は言語数）
+    stats: dict = {}
+    if job.get("fanout"):
+        languages = [t["language"] for t in job["fanout"]]
+        return _generate_html_multi(job["question"], job["answer"], cfg, languages, stats), stats
+    lang = job.get("language")
+    job_cfg = dict(cfg, **{"03_language": lang}) if lang else cfg
+    html, err = _generate_html(job["question"], job["answer"], job_cfg, stats)
+    return [(lang, html, err)], stats
+
+
+def _job_key(job: dict) -> tuple:
+    # 同じ内容・同じ言語のジョブは1回だけ生成する
+    langs = tuple(t["language"] for t in job["fanout"]) if job.get("fanout") else (job.get("language"),)
+    return job["question"], job["answer"], langs
+
+
+def _expand_results(job: dict, lang_results: list) -> list[tuple[dict, Optional[str], Optional[str]]]:
+    # (language, html, err) を「書き込み先ごとのジョブ」に展開する
+    targets = {t["language"]: t["e_field"] for t in job["fanout"]} if job.get("fanout") else {job.get("language"): job["e_field"]}
+    out = []
+    for lang, html, err in lang_results:
+        sub = {k: v for k, v in job.items() if k != "fanout"}
+        sub["language"] = lang
+        sub["e_field"] = targets[lang]
+        out.append((sub, html, err))
+    return out
+
+
+def _run_jobs(
+    jobs: list[dict],
+    cfg: AddonConfig,
+    workers: int = 1,
+    budget: Optional[RunBudget] = None,
+    stats: Optional[dict] = None,
+    monitor: Optional[dict] = None,
+) -> tuple[list[tuple[dict, Optional[str], Optional[str]]], list[dict]]:
+    """
+    jobs を最大 workers 並列で生成する（note/col には触らない）。
+
+    戻り値は (results, remaining)。results は書き込み先（ノート x フィールド）ごとの
+    (job, html, err)。同じ内容のジョブは1回だけ生成して結果を共有する（"deduped"）。
+    予算を超えたら新しいジョブは投げず、実行中のものは最後まで待つ。
+    投げなかったジョブが remaining に残る。
+    monitor を渡すと "pending" / "inflight"（待ち行列の長さ）を随時書き込む。
+    """
+    workers = max(1, workers)
+    groups: dict[tuple, list[dict]] = {}
+    for job in jobs:
+        groups.setdefault(_job_key(job), []).append(job)
+    pending = deque(groups.values())
+    results: list[tuple[dict, Optional[str], Optional[str]]] = []
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        inflight: dict = {}
+        while pending or inflight:
+            while pending and len(inflight) < workers and not (budget and budget.exceeded()):
+                group = pending.popleft()
+                inflight[pool.submit(_generate_for_job, group[0], cfg)] = group
+            if monitor is not None:
+                monitor["pending"] = len(pending)
+                monitor["inflight"] = len(inflight)
+            if not inflight:
+                break
+            done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+            for fut in done:
+                group = inflight.pop(fut)
+                lang_results, job_stats = fut.result()
+                for k, v in job_stats.items():
+                    _bump(stats, k, v)
+                _bump(stats, "deduped", len(group) - 1)
+                group_results = [r for job in group for r in _expand_results(job, lang_results)]
+                if budget:
+                    budget.record(job_stats, group_results)
+                results.extend(group_results)
+
+    if monitor is not None:
+        monitor["inflight"] = 0
+    return results, [job for group in pending for job in group]
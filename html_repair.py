@@ -0,0 +1,255 @@
+# html_repair.py
+from __future__ import annotations
+
+import re
+from html import escape
+from html.parser import HTMLParser
+from typing import Optional, Union
+
+# Anki (aqt) には依存しない。モデル出力の後処理だけを行う。
+
+# カードに書き込んでよいタグ（属性はすべて落とす）
+ALLOWED_TAGS = frozenset({
+    "p", "br", "hr", "div", "span",
+    "ul", "ol", "li",
+    "b", "strong", "i", "em", "u", "mark", "small", "sub", "sup", "code",
+    "h3", "h4",
+    "ruby", "rt", "rp",  # ふりがな
+    "table", "thead", "tbody", "tr", "th", "td",
+})
+VOID_TAGS = frozenset({"br", "hr"})
+# 中身ごと捨てるタグ
+DROP_CONTENT_TAGS = frozenset({"script", "style", "head", "title", "iframe", "object", "embed", "noscript"})
+# 許可外のブロック要素は近い許可タグに置き換える（中身だけ残すと前後の文がつながる）
+BLOCK_TAG_MAP = {
+    "h1": "h3", "h2": "h3", "h5": "h4", "h6": "h4",
+    "pre": "p", "blockquote": "div", "section": "div", "article": "div",
+    "header": "div", "footer": "div", "main": "div", "aside": "div",
+    "figure": "div", "figcaption": "p", "dl": "div", "dt": "p", "dd": "p",
+}
+
+# ```html / ``` だけの行（閉じていないフェンスや途中のフェンスも含む）
+_RE_FENCE_LINE = re.compile(r"^[ \t]*```[ \t]*[a-zA-Z0-9_-]*[ \t]*$", re.MULTILINE)
+# "Here is the explanation:" のような前置き
+_RE_PREAMBLE = re.compile(
+    r"^(?:(?:sure|certainly|of course|okay|ok)\b[^\n<]*"
+    r"|here(?:'s|\u2019s|\s+is|\s+are)\b[^\n<]*"
+    r"|(?:explanation|html|output)[ \t]*:[ \t]*)\n",
+    re.IGNORECASE,
+)
+_RE_TAG = re.compile(r"<\s*/?\s*[a-zA-Z][^>]*>")
+_RE_BULLET = re.compile(r"^\s*[-*•]\s+")
+
+# target_length に対してこの倍率を超えたら末尾から削る
+LENGTH_LIMIT_FACTOR = 2.0
+# 削った結果これより短く残るブロックは、中途半端なので丸ごと落とす
+MIN_TRIMMED_BLOCK = 40
+# 丸ごと残すか落とすかで扱う要素（途中で切らない）
+ATOMIC_TAGS = frozenset({"li", "tr"})
+_RE_SENTENCE_END = re.compile(r"[.!?](?=\s)|[。！？]")
+
+
+class _Node:
+    __slots__ = ("tag", "children")
+
+    def __init__(self, tag: str) -> None:
+        self.tag = tag
+        self.children: list[Union["_Node", str]] = []
+
+
+class _Balancer(HTMLParser):
+    """許可タグだけを残しつつ、開き/閉じタグの対応を取り直して木にする。"""
+
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=True)
+        self.root = _Node("")
+        self.stack: list[_Node] = [self.root]
+        self.drop_depth = 0
+        self.repairs: set[str] = set()
+
+    def handle_starttag(self, tag, attrs):
+        if tag in DROP_CONTENT_TAGS:
+            self.drop_depth += 1
+            self.repairs.add("sanitized")
+            return
+        if self.drop_depth:
+            return
+        if tag in BLOCK_TAG_MAP:
+            tag = BLOCK_TAG_MAP[tag]
+            self.repairs.add("sanitized")
+        if tag not in ALLOWED_TAGS:
+            # 未知のタグ（html/body/markdown など）は中身だけ残す
+            self.repairs.add("sanitized")
+            return
+        if attrs:
+            self.repairs.add("sanitized")
+        node = _Node(tag)
+        self.stack[-1].children.append(node)
+        if tag not in VOID_TAGS:
+            self.stack.append(node)
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in DROP_CONTENT_TAGS:
+            self.repairs.add("sanitized")
+            return
+        self.handle_starttag(tag, attrs)
+        tag = BLOCK_TAG_MAP.get(tag, tag)
+        if tag in ALLOWED_TAGS and tag not in VOID_TAGS and not self.drop_depth:
+            self.stack.pop()
+
+    def handle_endtag(self, tag):
+        if tag in DROP_CONTENT_TAGS:
+            self.drop_depth = max(0, self.drop_depth - 1)
+            return
+        tag = BLOCK_TAG_MAP.get(tag, tag)
+        if self.drop_depth or tag not in ALLOWED_TAGS or tag in VOID_TAGS:
+            return
+        open_tags = [n.tag for n in self.stack[1:]]
+        if tag not in open_tags:
+            # 対応する開きタグがない閉じタグは捨てる
+            self.repairs.add("balanced")
+            return
+        while self.stack[-1].tag != tag:
+            self.stack.pop()
+            self.repairs.add("balanced")
+        self.stack.pop()
+
+    def handle_data(self, data):
+        if self.drop_depth:
+            return
+        self.stack[-1].children.append(data)
+
+    def close(self):
+        super().close()
+        if len(self.stack) > 1:
+            self.repairs.add("balanced")
+        del self.stack[1:]
+
+
+def _serialize(node: _Node) -> str:
+    out: list[str] = []
+    for ch in node.children:
+        if isinstance(ch, str):
+            out.append(escape(ch, quote=False))
+        elif ch.tag in VOID_TAGS:
+            out.append(f"<{ch.tag}>")
+        else:
+            out.append(f"<{ch.tag}>{_serialize(ch)}</{ch.tag}>")
+    return "".join(out)
+
+
+def _text_len(node: Union[_Node, str]) -> int:
+    if isinstance(node, str):
+        return len(node.strip())
+    return sum(_text_len(ch) for ch in node.children)
+
+
+def _cut_text(text: str, budget: int) -> str:
+    # 文の切れ目で切る。切れ目がなければ語の切れ目で切って "…" を付ける
+    head = text[:budget]
+    ends = [m.end() for m in _RE_SENTENCE_END.finditer(head)]
+    if ends:
+        return head[:ends[-1]]
+    space = head.rfind(" ")
+    if space > budget // 2:
+        head = head[:space]
+    return head.rstrip() + "…"
+
+
+def _trim(node: _Node, budget: int) -> bool:
+    """
+    node の文字数を budget 以内に収める。収まらない最後の子について、
+    li/tr は丸ごと落とし、それ以外のブロックは中に降りて削る。
+    削ったら True。
+    """
+    if _text_len(node) <= budget:
+        return False
+    used = 0
+    for i, ch in enumerate(node.children):
+        n = _text_len(ch)
+        if used + n <= budget:
+            used += n
+            continue
+        rest = budget - used
+        del node.children[i + 1:]
+        if used and (rest < MIN_TRIMMED_BLOCK or (isinstance(ch, _Node) and ch.tag in ATOMIC_TAGS)):
+            # 先頭以外の li/tr や、ほとんど残らないブロックは丸ごと落とす
+            node.children.pop()
+        elif isinstance(ch, str):
+            node.children[i] = _cut_text(ch.strip(), rest)
+        else:
+            _trim(ch, rest)
+            if _text_len(ch) == 0:
+                node.children.pop()
+        return True
+    return False
+
+
+def _plain_text_to_html(t: str) -> str:
+    # タグが1つもない出力は段落/箇条書きに組み直す
+    blocks = [b.strip() for b in re.split(r"\n\s*\n", t) if b.strip()]
+    out: list[str] = []
+    for b in blocks:
+        lines = [ln for ln in b.splitlines() if ln.strip()]
+        if lines and all(_RE_BULLET.match(ln) for ln in lines):
+            items = "".join(f"<li>{escape(_RE_BULLET.sub('', ln).strip(), quote=False)}</li>" for ln in lines)
+            out.append(f"<ul>{items}</ul>")
+        else:
+            out.append("<p>" + "<br>".join(escape(ln.strip(), quote=False) for ln in lines) + "</p>")
+    return "".join(out)
+
+
+def repair_html(raw: str, target_len: int = 260) -> tuple[Optional[str], list[str]]:
+    """
+    モデル出力を検証・修復する。
+
+    戻り値は (html, repairs)。repairs は実際に行った修復の種類
+    ("fence", "preamble", "wrapped", "sanitized", "balanced", "length")。
+    ローカルでは直せない（中身が空など）場合は html が None になるので、
+    呼び出し側で再リクエストする。
+    """
+    repairs: list[str] = []
+    t = (raw or "").strip()
+    if not t:
+        return None, repairs
+
+    # 1) 部分的なフェンス（閉じていない ```html、途中の ``` など）を剥がす
+    t2 = _RE_FENCE_LINE.sub("", t).strip()
+    t2 = re.sub(r"^```[a-zA-Z0-9_-]*\s*|\s*```$", "", t2).strip()
+    if t2 != t:
+        repairs.append("fence")
+        t = t2
+
+    # 2) 先頭の説明文（"Here is ...:" 等）を落とす（プレーンテキストの出力も同じ）
+    if not t.startswith("<"):
+        m = _RE_PREAMBLE.match(t)
+        if m:
+            t = t[m.end():].lstrip()
+            repairs.append("preamble")
+
+    # 3) タグがなければ HTML に組み直す
+    if not _RE_TAG.search(t):
+        t = _plain_text_to_html(t)
+        repairs.append("wrapped")
+
+    # 4) 許可タグでサニタイズし、タグの対応を取る
+    parser = _Balancer()
+    try:
+        parser.feed(t)
+        parser.close()
+    except Exception:
+        return None, repairs
+    root = parser.root
+    repairs.extend(sorted(parser.repairs))
+
+    # 5) 長さ：目安の LENGTH_LIMIT_FACTOR 倍を超えたら末尾から削る
+    #    （1つの <div>/<ul>/<p> に全部入っていても中に降りて削る）
+    limit = int(max(80, target_len) * LENGTH_LIMIT_FACTOR)
+    if _trim(root, limit):
+        repairs.append("length")
+
+    if _text_len(root) == 0:
+        return None, repairs
+
+    html_out = _serialize(root).strip()
+    return html_out, repairs
@@ -0,0 +1,475 @@
+# soak.py
+"""
+Soak test: run the batch path (_start_batch) over and over for hours against a
+local fake OpenAI-compatible provider and record process health over time.
+
+Enabled with 08_soak_test_menu. Samples RSS, open sockets, threads, job queue
+depth and main-thread stalls, then writes a report to user_files/.
+"""
+from __future__ import annotations
+
+import csv
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+
+SAMPLE_SECONDS = 30
+HEARTBEAT_MS = 50
+# 次の周回まで少し空ける（この間にメニューから停止できる）
+ITERATION_PAUSE_MS = 2000
+
+# 判定のしきい値
+STALL_P95_LIMIT_MS = 100.0
+RSS_LEAK_MB_PER_HOUR = 10.0
+SOCKET_GROWTH_LIMIT = 5
+THREAD_GROWTH_LIMIT = 3
+THROUGHPUT_DECAY_RATIO = 0.8
+
+
+# ==============================
+# Fake provider (OpenAI compatible)
+# ==============================
+
+def _fake_explanation(prompt: str, n: int) -> str:
+    digest = hashlib.sha1(prompt.encode("utf-8")).hexdigest()[:8]
+    html = (
+        f"<p>Fake explanation {digest}: the definition comes first.</p>"
+        "<ul><li>Mechanism in one line.</li><li>Why it matters.</li></ul>"
+    )
+    # 一部はわざと崩して修復処理も通す
+    if n % 10 == 3:
+        return "```html\n" + html + "\n```"
+    if n % 10 == 7:
+        return "Here is the explanation:\n" + html.replace("</li></ul>", "")
+    return html
+
+
+class _FakeHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        srv: FakeProvider = self.server  # type: ignore[assignment]
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length) or b"{}")
+        with srv.lock:
+            srv.requests += 1
+            n = srv.requests
+
+        time.sleep(srv.latency * random.uniform(0.5, 1.5))
+        if random.random() < srv.error_rate:
+            self.send_response(500)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        prompt = (body.get("messages") or [{}])[-1].get("content", "")
+        text = _fake_explanation(prompt, n)
+        data = json.dumps({
+            "choices": [{"message": {"role": "assistant", "content": text}}],
+            "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(text) // 4},
+        }).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeProvider(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency_ms: int = 300, error_rate: float = 0.02) -> None:
+        super().__init__(("127.0.0.1", 0), _FakeHandler)
+        self.latency = max(0, latency_ms) / 1000
+        self.error_rate = max(0.0, min(1.0, error_rate))
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+    def start(self) -> None:
+        threading.Thread(target=self.serve_forever, name="ai-explainer-fake-provider", daemon=True).start()
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+# ==============================
+# Process metrics
+# ==============================
+
+def _rss_mb() -> Optional[float]:
+    try:
+        import psutil  # optional
+
+        return psutil.Process().memory_info().rss / (1024 * 1024)
+    except Exception:
+        pass
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def _open_sockets() -> Optional[int]:
+    try:
+        import psutil  # optional
+
+        proc = psutil.Process()
+        conns = getattr(proc, "net_connections", None) or proc.connections
+        return len(conns(kind="all"))
+    except Exception:
+        pass
+    try:
+        fd_dir = "/proc/self/fd"
+        count = 0
+        for fd in os.listdir(fd_dir):
+            try:
+                if os.readlink(os.path.join(fd_dir, fd)).startswith("socket:"):
+                    count += 1
+            except OSError:
+                continue
+        return count
+    except OSError:
+        return None
+
+
+def _percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    s = sorted(values)
+    return s[min(len(s) - 1, int(round(pct / 100 * (len(s) - 1))))]
+
+
+class StallHistogram:
+    """
+    全期間のストール値をすべて持つと 48 時間で数百万件になるので、
+    固定幅のバケットに数えるだけにする（1000 ms までは 1 ms 刻み、それ以上は 10 ms 刻み）。
+    """
+
+    FINE_LIMIT_MS = 1000
+    COARSE_STEP_MS = 10
+    CAP_MS = 60000
+
+    def __init__(self) -> None:
+        self.buckets: dict[int, int] = {}
+        self.count = 0
+        self.max = 0.0
+
+    def add_all(self, values: list[float]) -> None:
+        for v in values:
+            ms = min(int(v), self.CAP_MS)
+            if ms >= self.FINE_LIMIT_MS:
+                ms -= ms % self.COARSE_STEP_MS
+            self.buckets[ms] = self.buckets.get(ms, 0) + 1
+            self.count += 1
+            self.max = max(self.max, v)
+
+    def percentile(self, pct: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = min(self.count - 1, int(round(pct / 100 * (self.count - 1))))
+        seen = 0
+        for ms in sorted(self.buckets):
+            seen += self.buckets[ms]
+            if seen > rank:
+                return float(ms)
+        return self.max
+
+
+def _slope_per_hour(points: list[tuple[float, float]]) -> float:
+    # 最小二乗の傾き（x は秒）を 1 時間あたりに直す
+    if len(points) < 2:
+        return 0.0
+    n = len(points)
+    mx = sum(x for x, _ in points) / n
+    my = sum(y for _, y in points) / n
+    den = sum((x - mx) ** 2 for x, _ in points)
+    if not den:
+        return 0.0
+    return sum((x - mx) * (y - my) for x, y in points) / den * 3600
+
+
+def _thirds(values: list[float]) -> tuple[list[float], list[float], list[float]]:
+    k = len(values) // 3
+    return values[:k], values[k:2 * k], values[2 * k:]
+
+
+def _mean(values: list[float]) -> float:
+    return sum(values) / len(values) if values else 0.0
+
+
+def analyze(samples: list[dict], iterations: list[dict], stalls: StallHistogram) -> list[str]:
+    """リーク・スループット低下・メインスレッド停止を判定し、見つかった問題を返す。"""
+    flags: list[str] = []
+    if len(samples) < 6 or len(iterations) < 3:
+        flags.append("Run too short for trend analysis (need >= 6 samples and >= 3 iterations).")
+
+    if len(samples) >= 6:
+        half = samples[len(samples) // 2:]
+        rss = [(s["t"], s["rss_mb"]) for s in half if s["rss_mb"] is not None]
+        slope = _slope_per_hour(rss)
+        if slope > RSS_LEAK_MB_PER_HOUR:
+            flags.append(f"Possible memory leak: RSS grows {slope:.1f} MB/h over the second half of the run.")
+
+        for key, limit, label in (
+            ("sockets", SOCKET_GROWTH_LIMIT, "socket"),
+            ("threads", THREAD_GROWTH_LIMIT, "thread"),
+        ):
+            values = [float(s[key]) for s in samples if s[key] is not None]
+            _first, middle, last = _thirds(values)
+            if middle and last and _mean(last) - _mean(middle) > limit:
+                flags.append(
+                    f"Possible {label} leak: {key} average {_mean(middle):.1f} -> {_mean(last):.1f} "
+                    "between the middle and last third of the run."
+                )
+
+    if len(iterations) >= 3:
+        first, _middle, last = _thirds([it["notes_per_s"] for it in iterations])
+        if first and last and _mean(last) < _mean(first) * THROUGHPUT_DECAY_RATIO:
+            flags.append(
+                f"Throughput decay: {_mean(first):.2f} -> {_mean(last):.2f} notes/s "
+                "between the first and last third of iterations."
+            )
+
+    p95 = stalls.percentile(95)
+    if p95 > STALL_P95_LIMIT_MS:
+        flags.append(f"Main-thread stalls: p95 {p95:.0f} ms (max {stalls.max:.0f} ms).")
+    return flags
+
+
+def _write_report(
+    out_dir: str,
+    meta: dict,
+    samples: list[dict],
+    iterations: list[dict],
+    stalls: StallHistogram,
+) -> tuple[str, str]:
+    os.makedirs(out_dir, exist_ok=True)
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    base = os.path.join(out_dir, f"soak-{stamp}")
+
+    if samples:
+        with open(base + "-samples.csv", "w", newline="", encoding="utf-8") as f:
+            w = csv.DictWriter(f, fieldnames=list(samples[0]))
+            w.writeheader()
+            w.writerows(samples)
+    if iterations:
+        with open(base + "-iterations.csv", "w", newline="", encoding="utf-8") as f:
+            w = csv.DictWriter(f, fieldnames=list(iterations[0]))
+            w.writeheader()
+            w.writerows(iterations)
+
+    def first_last(key: str) -> str:
+        values = [s[key] for s in samples if s[key] is not None]
+        if not values:
+            return "n/a | n/a | n/a"
+        return f"{values[0]:.1f} | {values[-1]:.1f} | {max(values):.1f}"
+
+    flags = analyze(samples, iterations, stalls)
+    lines = [
+        "# AI Card Explainer soak test",
+        "",
+        f"- Started: {meta['started']}",
+        f"- Duration: {meta['elapsed_s'] / 3600:.2f} h (planned {meta['hours']:.2f} h)",
+        f"- Notes per iteration: {meta['notes']}",
+        f"- Fake provider: latency {meta['latency_ms']} ms, error rate {meta['error_rate']:.0%}, "
+        f"{meta['requests']} requests",
+        f"- Iterations: {len(iterations)}",
+        "",
+        "## Findings",
+        "",
+    ]
+    lines += [f"- {flag}" for flag in flags] or ["- No leaks, throughput decay or long stalls detected."]
+    lines += [
+        "",
+        "## Process",
+        "",
+        "| Metric | Start | End | Max |",
+        "|---|---|---|---|",
+        f"| RSS (MB) | {first_last('rss_mb')} |",
+        f"| Open sockets (incl. fake provider) | {first_last('sockets')} |",
+        f"| Threads | {first_last('threads')} |",
+        f"| Queue: pending jobs | {first_last('pending')} |",
+        f"| Queue: in-flight jobs | {first_last('inflight')} |",
+        "",
+        "## Main thread",
+        "",
+        f"Heartbeat every {HEARTBEAT_MS} ms; a stall is how late a beat fired.",
+        f"p50 {stalls.percentile(50):.0f} ms, p95 {stalls.percentile(95):.0f} ms, "
+        f"p99 {stalls.percentile(99):.0f} ms, max {stalls.max:.1f} ms ({stalls.count} beats)",
+        "",
+        "## Throughput",
+        "",
+    ]
+    if iterations:
+        rates = [it["notes_per_s"] for it in iterations]
+        first, _middle, last = _thirds(rates)
+        lines.append(
+            f"notes/s: first third {_mean(first or rates):.2f}, last third {_mean(last or rates):.2f}, "
+            f"overall {_mean(rates):.2f}"
+        )
+    lines += ["", f"Raw data: `{os.path.basename(base)}-samples.csv`, `{os.path.basename(base)}-iterations.csv`", ""]
+
+    report = "\n".join(lines)
+    with open(base + ".md", "w", encoding="utf-8") as f:
+        f.write(report)
+    return base + ".md", report
+
+
+# ==============================
+# Runner (Anki main thread)
+# ==============================
+
+class SoakTest:
+    """
+    start_batch(nids, cfg, on_finished=..., monitor=...) を繰り返し呼ぶ。
+
+    タイマーはすべてメインスレッドの QTimer。stop() は実行中の周回が終わってから止まる。
+    """
+
+    def __init__(
+        self,
+        nids: list[int],
+        cfg: dict,
+        hours: float,
+        out_dir: str,
+        start_batch: Callable,
+        on_report: Callable[[str, str], None],
+    ) -> None:
+        from aqt import mw
+        from aqt.qt import QTimer
+
+        self.nids = list(nids)
+        self.hours = hours
+        self.out_dir = out_dir
+        self.start_batch = start_batch
+        self.on_report = on_report
+
+        self.latency_ms = int(cfg.get("08_soak_latency_ms", 300) or 0)
+        self.error_rate = float(cfg.get("08_soak_error_rate", 0.02) or 0)
+        self.provider = FakeProvider(self.latency_ms, self.error_rate)
+        # 本物の API キーやエンドポイントは使わない。既存の説明は毎回上書きする
+        self.cfg = dict(
+            cfg,
+            **{
+                "01_provider": "openai",
+                "01_openai_api_key": "soak-test",
+                "01_openai_base_url": self.provider.base_url,
+                "04_on_existing_behavior": "overwrite",
+                "07_budget_max_tokens": 0,
+                "07_budget_max_cost_usd": 0,
+                "07_budget_max_minutes": 0,
+                "07_budget_max_error_rate": 0,
+            },
+        )
+
+        self.monitor: dict = {"pending": 0, "inflight": 0}
+        self.samples: list[dict] = []
+        self.iterations: list[dict] = []
+        # 周回ごとの p50/p95/max は samples に入るので、全体はヒストグラムだけ持つ
+        self.stalls = StallHistogram()
+        self._window_stalls: list[float] = []
+        self._last_beat: Optional[float] = None
+        self._iter_started = 0.0
+        self.started_wall = time.strftime("%Y-%m-%d %H:%M:%S")
+        self.started = 0.0
+        self.stopping = False
+
+        self.heartbeat = QTimer(mw)
+        self.heartbeat.setInterval(HEARTBEAT_MS)
+        self.heartbeat.timeout.connect(self._beat)
+        self.sampler = QTimer(mw)
+        self.sampler.setInterval(SAMPLE_SECONDS * 1000)
+        self.sampler.timeout.connect(self._sample)
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def start(self) -> None:
+        self.provider.start()
+        self.started = time.monotonic()
+        self.heartbeat.start()
+        self.sampler.start()
+        self._sample()
+        self._next_iteration()
+
+    def stop(self) -> None:
+        self.stopping = True
+
+    def _beat(self) -> None:
+        now = time.perf_counter()
+        if self._last_beat is not None:
+            late = (now - self._last_beat) * 1000 - HEARTBEAT_MS
+            self._window_stalls.append(max(0.0, late))
+        self._last_beat = now
+
+    def _sample(self) -> None:
+        stalls, self._window_stalls = self._window_stalls, []
+        self.stalls.add_all(stalls)
+        self.samples.append({
+            "t": round(self.elapsed, 1),
+            "rss_mb": _rss_mb(),
+            "sockets": _open_sockets(),
+            "threads": threading.active_count(),
+            "pending": self.monitor.get("pending", 0),
+            "inflight": self.monitor.get("inflight", 0),
+            "stall_p50_ms": round(_percentile(stalls, 50), 1),
+            "stall_p95_ms": round(_percentile(stalls, 95), 1),
+            "stall_max_ms": round(max(stalls, default=0.0), 1),
+            "iterations": len(self.iterations),
+        })
+
+    def _next_iteration(self) -> None:
+        if self.stopping or self.elapsed >= self.hours * 3600:
+            self._finish()
+            return
+        self._iter_started = time.monotonic()
+        self.start_batch(self.nids, self.cfg, on_finished=self._on_iteration, monitor=self.monitor)
+
+    def _on_iteration(self, summary: dict) -> None:
+        from aqt.qt import QTimer
+
+        seconds = time.monotonic() - self._iter_started
+        generated = int(summary.get("generated", 0))
+        self.iterations.append({
+            "index": len(self.iterations) + 1,
+            "t": round(self.elapsed, 1),
+            "seconds": round(seconds, 2),
+            "generated": generated,
+            "errors": int(summary.get("errors", 0)),
+            "notes_per_s": round(generated / seconds, 3) if seconds > 0 else 0.0,
+            "failed": summary.get("error", ""),
+        })
+        QTimer.singleShot(ITERATION_PAUSE_MS, self._next_iteration)
+
+    def _finish(self) -> None:
+        self.heartbeat.stop()
+        self.sampler.stop()
+        self._sample()
+        self.provider.stop()
+        meta = {
+            "started": self.started_wall,
+            "elapsed_s": self.elapsed,
+            "hours": self.hours,
+            "notes": len(self.nids),
+            "latency_ms": self.latency_ms,
+            "error_rate": self.error_rate,
+            "requests": self.provider.requests,
+        }
+        path, report = _write_report(self.out_dir, meta, self.samples, self.iterations, self.stalls)
+        self.on_report(path, report)
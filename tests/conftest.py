@@ -0,0 +1,24 @@
+import os
+import sys
+import types
+
+# add-on のフォルダ名は環境ごとに違い、__init__.py は aqt を読むので、
+# フォルダを "ai_explainer" パッケージとして登録して core などだけを import する
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if "ai_explainer" not in sys.modules:
+    pkg = types.ModuleType("ai_explainer")
+    pkg.__path__ = [ROOT]
+    sys.modules["ai_explainer"] = pkg
+
+
+class FakeNote(dict):
+    """anki.notes.Note の代わり（フィールドの読み書き・id・mid・note_type だけ）。"""
+
+    def __init__(self, nid: int, fields: dict, note_type: str = "Basic", mid: int = 1) -> None:
+        super().__init__(fields)
+        self.id = nid
+        self.mid = mid
+        self._note_type = note_type
+
+    def note_type(self) -> dict:
+        return {"name": self._note_type}
@@ -0,0 +1,114 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from html_repair import _text_len, repair_html, _Balancer  # noqa: E402
+
+
+def _len(html: str) -> int:
+    parser = _Balancer()
+    parser.feed(html)
+    parser.close()
+    return _text_len(parser.root)
+
+
+def test_clean_html_is_unchanged():
+    html, repairs = repair_html("<p>Short <b>answer</b>.</p>")
+    assert html == "<p>Short <b>answer</b>.</p>"
+    assert repairs == []
+
+
+def test_empty_output_needs_rerequest():
+    assert repair_html("") == (None, [])
+    html, _repairs = repair_html("```html\n```")
+    assert html is None
+
+
+def test_unclosed_fence_is_stripped():
+    html, repairs = repair_html("```html\n<p>Body</p>")
+    assert html == "<p>Body</p>"
+    assert "fence" in repairs
+
+
+def test_preamble_is_dropped():
+    html, repairs = repair_html("Here is the explanation:\n<p>Body</p>")
+    assert html == "<p>Body</p>"
+    assert "preamble" in repairs
+
+    html, repairs = repair_html("Sure, here you go\n<p>Body</p>")
+    assert html == "<p>Body</p>"
+    assert "preamble" in repairs
+
+
+def test_preamble_is_dropped_from_plain_text():
+    html, repairs = repair_html("Here is the explanation:\nThe heart pumps blood.")
+    assert html == "<p>The heart pumps blood.</p>"
+    assert "preamble" in repairs
+    assert "wrapped" in repairs
+
+
+def test_content_line_ending_in_colon_is_kept():
+    html, repairs = repair_html("Note:\n<p>Body</p>")
+    assert html.startswith("Note:")
+    assert "preamble" not in repairs
+
+
+def test_plain_text_is_wrapped():
+    html, repairs = repair_html("First line\nsecond line\n\n- one\n- two")
+    assert html == "<p>First line<br>second line</p><ul><li>one</li><li>two</li></ul>"
+    assert "wrapped" in repairs
+
+
+def test_disallowed_tags_and_attributes_are_sanitized():
+    html, repairs = repair_html('<p onclick="x()">Hi<script>alert(1)</script></p><img src="a.png">')
+    assert html == "<p>Hi</p>"
+    assert "sanitized" in repairs
+
+
+def test_block_tags_are_mapped_not_unwrapped():
+    html, _repairs = repair_html("<h2>Title</h2><p>Body</p><blockquote>Quoted</blockquote>More")
+    assert html == "<h3>Title</h3><p>Body</p><div>Quoted</div>More"
+    html, _repairs = repair_html("<h5>Small</h5><pre>code</pre>")
+    assert html == "<h4>Small</h4><p>code</p>"
+
+
+def test_ruby_is_kept():
+    html, repairs = repair_html("<p><ruby>心筋梗塞<rp>(</rp><rt>しんきんこうそく</rt><rp>)</rp></ruby>は…</p>")
+    assert html == "<p><ruby>心筋梗塞<rp>(</rp><rt>しんきんこうそく</rt><rp>)</rp></ruby>は…</p>"
+    assert repairs == []
+
+
+def test_unbalanced_tags_are_closed():
+    html, repairs = repair_html("<div><p>Open <b>bold</p></i>")
+    assert html == "<div><p>Open <b>bold</b></p></div>"
+    assert "balanced" in repairs
+
+
+def test_long_top_level_blocks_are_dropped():
+    para = "<p>" + "Sentence here. " * 10 + "</p>"
+    html, repairs = repair_html(para * 10, target_len=260)
+    assert "length" in repairs
+    assert _len(html) <= 520
+    assert html.endswith("</p>")
+
+
+def test_single_long_paragraph_is_cut_at_sentence():
+    html, repairs = repair_html("<p>" + "This is a sentence. " * 100 + "</p>", target_len=260)
+    assert "length" in repairs
+    assert _len(html) <= 520
+    assert html.endswith("sentence.</p>")
+
+
+def test_single_long_list_drops_trailing_items():
+    items = "".join(f"<li>Item {i} " + "x" * 60 + "</li>" for i in range(20))
+    html, repairs = repair_html(f"<div><ul>{items}</ul></div>", target_len=260)
+    assert "length" in repairs
+    assert 0 < _len(html) <= 520
+    assert html.startswith("<div><ul><li>Item 0 ")
+    assert html.endswith("</li></ul></div>")
+
+
+def test_short_output_is_not_trimmed():
+    _html, repairs = repair_html("<ul><li>a</li><li>b</li></ul>", target_len=260)
+    assert "length" not in repairs
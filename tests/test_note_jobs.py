@@ -0,0 +1,101 @@
+import pytest
+from conftest import FakeNote
+
+from ai_explainer import core
+
+CFG = {"01_provider": "gemini", "01_gemini_api_key": "test", "04_on_existing_behavior": "skip"}
+
+
+def test_per_note_type_fields_with_multiple_sources():
+    cfg = dict(CFG, **{
+        "02_note_type_fields": {
+            "Cloze": {"question": "Text", "answer": ["Back Extra", "extra2"], "explanation": "Notes"},
+        },
+    })
+    cache = {}
+    cloze = FakeNote(1, {"Text": "q", "Back Extra": "a1", "Extra2": "a2", "Notes": ""}, "Cloze", mid=20)
+    job, err = core._prepare_note_job_from_note(cloze, cfg, cache)
+    assert err is None
+    assert (job["question"], job["answer"], job["e_field"]) == ("q", "a1\na2", "Notes")
+
+    # 設定のないノートタイプはグローバルのフィールドを使う
+    basic = FakeNote(2, {"Front": "f", "Back": "b", "Explanation": ""}, "Basic", mid=10)
+    job, err = core._prepare_note_job_from_note(basic, cfg, cache)
+    assert (job["question"], job["answer"], job["e_field"]) == ("f", "b", "Explanation")
+    assert set(cache) == {10, 20}
+
+
+def test_missing_explanation_field_is_skipped():
+    note = FakeNote(1, {"Front": "f", "Back": "b"}, "Other")
+    job, err = core._prepare_note_job_from_note(note, CFG)
+    assert job is None
+    assert "Explanation field does not exist" in err
+
+
+@pytest.mark.parametrize("bad", [
+    {"02_note_type_fields": {"Basic": "Front"}},
+    {"02_note_type_fields": ["Basic"]},
+    {"03_fanout_fields": ["en"]},
+])
+def test_malformed_config_entries_are_ignored(bad):
+    note = FakeNote(1, {"Front": "f", "Back": "b", "Explanation": ""})
+    jobs, err = core._prepare_note_jobs(note, dict(CFG, **bad))
+    assert err is None
+    assert [job["e_field"] for job in jobs] == ["Explanation"]
+
+
+def test_fanout_parallel_and_combined_jobs():
+    note = FakeNote(1, {"Front": "f", "Back": "b", "Ex EN": "", "Ex JA": "done"})
+    cfg = dict(CFG, **{"03_fanout_fields": {"en": "ex en", "ja": "Ex JA", "de": "Ex DE"}})
+    jobs, err = core._prepare_note_jobs(note, dict(cfg, **{"04_on_existing_behavior": "overwrite"}))
+    assert [(job["language"], job["e_field"]) for job in jobs] == [("en", "Ex EN"), ("ja", "Ex JA")]
+    assert err is None  # 一部の言語のフィールドがないだけならエラーにしない
+
+    jobs, err = core._prepare_note_jobs(note, dict(CFG, **{"03_fanout_fields": {"de": "Ex DE"}}))
+    assert jobs == []
+    assert "'Ex DE' does not exist" in err
+
+    jobs, _err = core._prepare_note_jobs(
+        note, dict(cfg, **{"04_on_existing_behavior": "overwrite", "03_fanout_mode": "combined"})
+    )
+    assert len(jobs) == 1
+    assert [t["language"] for t in jobs[0]["fanout"]] == ["en", "ja"]
+
+    # 既存の解説は skip なら作らない
+    jobs, _err = core._prepare_note_jobs(note, cfg)
+    assert [job["language"] for job in jobs] == ["en"]
+
+
+def test_unknown_language_codes_are_not_generated_in_english():
+    note = FakeNote(1, {"Front": "f", "Back": "b", "Explanation": "", "JA": "", "TW": ""})
+    jobs, err = core._prepare_note_jobs(note, dict(CFG, **{"03_fanout_fields": {"jp": "JA"}}))
+    assert jobs == []
+    assert "Unknown language code 'jp'" in err
+
+    jobs, err = core._prepare_note_jobs(note, dict(CFG, **{"03_fanout_fields": {"ja": "JA", "zh-tw": "TW"}}))
+    assert [job["language"] for job in jobs] == ["ja"]
+    assert "zh-tw" in err
+
+
+def test_split_language_sections():
+    raw = "intro\n<!-- lang:EN -->\n<p>EN</p>\n<!--lang: ja-->\n<p>JA</p>\n<!-- lang:de -->\n"
+    assert core._split_language_sections(raw) == {"en": "<p>EN</p>", "ja": "<p>JA</p>"}
+
+
+def test_combined_mode_falls_back_for_missing_language(monkeypatch):
+    prompts = []
+
+    def fake_call_model(cfg, api_key, system_prompt, user_prompt, stats=None, max_tokens=512):
+        prompts.append(user_prompt)
+        if "EACH of these languages" in user_prompt:
+            # de が欠けた応答
+            return "<!-- lang:en -->\n<p>EN</p>\n<!-- lang:ja -->\n```html\n<p>JA</p>\n```"
+        return "<p>single</p>"
+
+    monkeypatch.setattr(core, "_call_model", fake_call_model)
+    stats = {}
+    out = core._generate_html_multi("q", "a", CFG, ["en", "ja", "de"], stats)
+    assert out == [("en", "<p>EN</p>", None), ("ja", "<p>JA</p>", None), ("de", "<p>single</p>", None)]
+    assert len(prompts) == 2
+    assert "German" in prompts[1]
+    assert stats["rerequested"] == 1
@@ -0,0 +1,87 @@
+import pytest
+
+from ai_explainer import core
+
+CFG = {"01_provider": "gemini", "01_gemini_api_key": "test"}
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    # _call_model の代わり：1回 10 + 5 トークン、"fail" を含む問題はエラー
+    prompts = []
+
+    def fake_call_model(cfg, api_key, system_prompt, user_prompt, stats=None, max_tokens=512):
+        prompts.append(user_prompt)
+        core._bump(stats, "prompt_tokens", 10)
+        core._bump(stats, "completion_tokens", 5)
+        if "fail" in user_prompt:
+            raise RuntimeError("boom")
+        return "<p>ok</p>"
+
+    monkeypatch.setattr(core, "_call_model", fake_call_model)
+    return prompts
+
+
+def _job(nid, question=None, **extra):
+    return dict(
+        {
+            "nid": nid,
+            "e_field": "Explanation",
+            "question": question or f"q{nid}",
+            "answer": "a",
+            "behavior": "overwrite",
+            "sep": "<hr>",
+        },
+        **extra,
+    )
+
+
+def test_identical_jobs_are_generated_once(calls):
+    stats = {}
+    jobs = [_job(1, "same"), _job(2, "same"), _job(3, "same"), _job(4, "other")]
+    results, remaining = core._run_jobs(jobs, CFG, workers=2, stats=stats)
+    assert len(calls) == 2
+    assert stats["deduped"] == 2
+    assert sorted(job["nid"] for job, _html, _err in results) == [1, 2, 3, 4]
+    assert all(html == "<p>ok</p>" for _job_, html, _err in results)
+    assert remaining == []
+
+
+def test_token_budget_stops_and_returns_unstarted_jobs(calls):
+    budget = core.RunBudget(dict(CFG, **{"07_budget_max_tokens": 30}))
+    monitor = {}
+    jobs = [_job(nid) for nid in range(1, 6)]
+    results, remaining = core._run_jobs(jobs, CFG, workers=1, budget=budget, monitor=monitor)
+    assert [job["nid"] for job, _html, _err in results] == [1, 2]
+    assert [job["nid"] for job in remaining] == [3, 4, 5]
+    assert budget.tokens == 30
+    assert budget.stop_reason.startswith("token budget reached")
+    assert monitor == {"pending": 3, "inflight": 0}
+
+
+def test_error_rate_counts_notes_not_requests():
+    budget = core.RunBudget({"07_budget_max_error_rate": 0.5})
+    # 1ノート2言語のうち1つだけ失敗 -> 1ノートの失敗
+    budget.record({}, [(_job(1, language="en"), "<p>x</p>", None), (_job(1, language="ja"), None, "err")])
+    # 重複をまとめた1リクエストでも、書き込み先のノートごとに数える
+    budget.record({}, [(_job(2), "<p>x</p>", None), (_job(3), "<p>x</p>", None)])
+    assert (budget.done, budget.errors) == (3, 1)
+    assert budget.exceeded() is None
+
+
+def test_error_rate_is_checked_once_enough_notes_finished():
+    budget = core.RunBudget({"07_budget_max_error_rate": 0.5})
+    for nid in range(1, core.ERROR_RATE_MIN_NOTES):
+        budget.record({}, [(_job(nid), None, "err")])
+    assert budget.exceeded() is None
+    budget.record({}, [(_job(core.ERROR_RATE_MIN_NOTES), None, "err")])
+    assert budget.exceeded().startswith("error rate too high")
+
+
+def test_failed_request_is_reported_per_job(calls):
+    budget = core.RunBudget(CFG)
+    results, remaining = core._run_jobs([_job(1, "fail"), _job(2)], CFG, budget=budget)
+    by_nid = {job["nid"]: (html, err) for job, html, err in results}
+    assert by_nid[1][0] is None and "boom" in by_nid[1][1]
+    assert by_nid[2] == ("<p>ok</p>", None)
+    assert (budget.done, budget.errors) == (2, 1)